@@ -0,0 +1,33 @@
+--
+-- 001: tombstones for deleted embeddings (delta sync for face_service)
+--
+-- Every row removed from students_embeddings (directly, or through the
+-- ON DELETE CASCADE from students_images / students) leaves a tombstone,
+-- so /public/api/get-embeddings-delta can tell the face service what to drop.
+--
+
+CREATE TABLE IF NOT EXISTS public.embedding_tombstones (
+    id bigserial PRIMARY KEY,
+    embedding_id integer NOT NULL,
+    image_id integer,
+    deleted_at timestamp without time zone DEFAULT now()
+);
+
+ALTER TABLE public.embedding_tombstones OWNER TO postgres;
+
+CREATE OR REPLACE FUNCTION public.record_embedding_tombstone() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    INSERT INTO public.embedding_tombstones (embedding_id, image_id) VALUES (OLD.id, OLD.image_id);
+    RETURN OLD;
+END;
+$$;
+
+ALTER FUNCTION public.record_embedding_tombstone() OWNER TO postgres;
+
+DROP TRIGGER IF EXISTS students_embeddings_tombstone ON public.students_embeddings;
+
+CREATE TRIGGER students_embeddings_tombstone
+    AFTER DELETE ON public.students_embeddings
+    FOR EACH ROW EXECUTE FUNCTION public.record_embedding_tombstone();
@@ -0,0 +1,53 @@
+--
+-- 002: pgvector column + HNSW index on students_embeddings (ANN_BACKEND=pgvector in face_service)
+--
+-- students_embeddings.vector stays the source of truth (double precision[]);
+-- a trigger mirrors every 512-d ArcFace vector into embedding_vec so the web
+-- service keeps writing plain arrays. Skipped entirely (with a notice) when the
+-- server does not ship the pgvector extension, so stock postgres images still boot.
+--
+
+DO $migration$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'vector') THEN
+        RAISE NOTICE 'pgvector is not installed on this server, skipping 002_pgvector_embeddings';
+        RETURN;
+    END IF;
+
+    CREATE EXTENSION IF NOT EXISTS vector;
+
+    ALTER TABLE public.students_embeddings ADD COLUMN IF NOT EXISTS embedding_vec vector(512);
+
+    CREATE OR REPLACE FUNCTION public.sync_embedding_vec() RETURNS trigger
+        LANGUAGE plpgsql
+        AS $$
+    BEGIN
+        IF array_length(NEW.vector, 1) = 512 THEN
+            NEW.embedding_vec := NEW.vector::vector(512);
+        ELSE
+            -- other models (e.g. 128-d) stay searchable through the in-memory gallery only
+            NEW.embedding_vec := NULL;
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+
+    ALTER FUNCTION public.sync_embedding_vec() OWNER TO postgres;
+
+    DROP TRIGGER IF EXISTS students_embeddings_sync_vec ON public.students_embeddings;
+
+    CREATE TRIGGER students_embeddings_sync_vec
+        BEFORE INSERT OR UPDATE OF vector ON public.students_embeddings
+        FOR EACH ROW EXECUTE FUNCTION public.sync_embedding_vec();
+
+    -- backfill rows written before this migration
+    UPDATE public.students_embeddings
+        SET embedding_vec = vector::vector(512)
+        WHERE embedding_vec IS NULL AND array_length(vector, 1) = 512;
+
+    -- cosine distance (<=>); HNSW needs no training and stays accurate as students are enrolled
+    CREATE INDEX IF NOT EXISTS students_embeddings_vec_hnsw
+        ON public.students_embeddings USING hnsw (embedding_vec vector_cosine_ops)
+        WITH (m = 16, ef_construction = 64);
+END
+$migration$;
@@ -0,0 +1,36 @@
+--
+-- 003: one attendance row per (student, period) + indexes for the hot query paths
+--
+-- The unique constraint lets every attendance write be a single
+-- INSERT ... ON CONFLICT (student_id, period_id), so racing marks can no
+-- longer create duplicate rows. Duplicates already in the table are folded
+-- into the most recent row first.
+--
+
+DELETE FROM public.attendance a
+    USING public.attendance b
+    WHERE a.student_id = b.student_id
+      AND a.period_id = b.period_id
+      AND a.id < b.id;
+
+DO $migration$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'attendance_student_period_key') THEN
+        ALTER TABLE ONLY public.attendance
+            ADD CONSTRAINT attendance_student_period_key UNIQUE (student_id, period_id);
+    END IF;
+END
+$migration$;
+
+-- running-period polls and date filters: WHERE status = ... AND date = ...
+CREATE INDEX IF NOT EXISTS periods_status_date_idx ON public.periods USING btree (status, date);
+
+-- a class's periods by subject and day
+CREATE INDEX IF NOT EXISTS periods_teacher_subject_id_date_idx ON public.periods USING btree (teacher_subject_id, date);
+
+-- TeacherSubject.class_id joins
+CREATE INDEX IF NOT EXISTS teachersubjects_class_id_idx ON public.teachersubjects USING btree (class_id);
+
+-- foreign keys used by the embeddings export joins and cascades
+CREATE INDEX IF NOT EXISTS students_images_student_id_idx ON public.students_images USING btree (student_id);
+CREATE INDEX IF NOT EXISTS students_embeddings_image_id_idx ON public.students_embeddings USING btree (image_id);
@@ -0,0 +1,22 @@
+--
+-- 004: shared state of face_service async jobs (JOB_STORE=postgres)
+--
+-- A job runs in the gunicorn worker that accepted it, but its status and
+-- result are written here, so GET /jobs/<id> works from any worker or replica.
+-- Times are unix timestamps (seconds), as in the /jobs/<id> response.
+--
+
+CREATE TABLE IF NOT EXISTS public.face_jobs (
+    id text PRIMARY KEY,
+    status text NOT NULL,
+    submitted_at double precision NOT NULL,
+    started_at double precision,
+    finished_at double precision,
+    result jsonb,
+    status_code integer,
+    error text
+);
+
+ALTER TABLE public.face_jobs OWNER TO postgres;
+
+CREATE INDEX IF NOT EXISTS face_jobs_finished_at_idx ON public.face_jobs (finished_at);
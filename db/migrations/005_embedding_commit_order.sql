@@ -0,0 +1,22 @@
+--
+-- 005: commit-safe delta cursors for /public/api/get-embeddings-delta
+--
+-- Serial ids are handed out at insert time, not commit time: a transaction
+-- holding a lower id can commit after one with a higher id, and an id cursor
+-- would skip it forever. Every embedding and tombstone now records the id of
+-- the transaction that wrote it (xid8). The delta endpoint only returns rows
+-- of transactions older than pg_snapshot_xmin(pg_current_snapshot()), which
+-- have all finished, and orders / pages by (txid, id).
+--
+
+ALTER TABLE public.students_embeddings
+    ADD COLUMN IF NOT EXISTS txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+ALTER TABLE public.embedding_tombstones
+    ADD COLUMN IF NOT EXISTS txid xid8 NOT NULL DEFAULT pg_current_xact_id();
+
+CREATE INDEX IF NOT EXISTS students_embeddings_txid_idx ON public.students_embeddings (txid, id);
+CREATE INDEX IF NOT EXISTS embedding_tombstones_txid_idx ON public.embedding_tombstones (txid, id);
+
+-- tombstones are pruned after EMBEDDING_TOMBSTONE_RETENTION seconds
+CREATE INDEX IF NOT EXISTS embedding_tombstones_deleted_at_idx ON public.embedding_tombstones (deleted_at);
@@ -0,0 +1,12 @@
+--
+-- 006: owner and age of unfinished face_service jobs
+--
+-- worker is "<hostname>:<pid>" of the gunicorn worker that queued the job. A
+-- job whose worker exited never finishes; a restarted worker fails the rows of
+-- dead workers on its host, and every worker fails unfinished rows older than
+-- JOB_MAX_AGE (found through the partial index on submitted_at).
+--
+
+ALTER TABLE public.face_jobs ADD COLUMN IF NOT EXISTS worker text;
+
+CREATE INDEX IF NOT EXISTS face_jobs_unfinished_idx ON public.face_jobs (submitted_at) WHERE finished_at IS NULL;
@@ -0,0 +1,119 @@
+"""
+Admission control for the frame pipeline (process_with_attendance and the burst endpoint).
+
+Every admitted frame is tracked from admission until its result is ready (in-flight work, including
+frames waiting in the async job queue or the micro-batchers). Recent per-frame service times are kept
+as an exponentially weighted average per stage; a new request is only admitted when
+
+    frame_seconds * (new_frames + frames_in_flight / ADMISSION_CONCURRENCY)
+
+fits in its deadline (ADMISSION_DEADLINE for synchronous requests, a bit under the Pi's 30s timeout).
+Otherwise it is rejected right away with 429 and a Retry-After estimate instead of timing out later.
+State is per process: each gunicorn worker only counts the frames routed to it, so with
+FACE_WORKERS workers the service as a whole admits up to FACE_WORKERS x ADMISSION_CONCURRENCY
+frames side by side. Size ADMISSION_CONCURRENCY for one worker.
+"""
+
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ADMISSION_CONTROL = os.getenv("ADMISSION_CONTROL", "true").lower() == "true"
+ADMISSION_DEADLINE = float(os.getenv("ADMISSION_DEADLINE", "25"))              # seconds, synchronous requests
+ADMISSION_ASYNC_DEADLINE = float(os.getenv("ADMISSION_ASYNC_DEADLINE", "120"))  # seconds, async jobs
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "2"))           # frames processed side by side
+ADMISSION_DEFAULT_FRAME_SECONDS = float(os.getenv("ADMISSION_DEFAULT_FRAME_SECONDS", "3"))  # until measured
+EWMA_ALPHA = 0.2
+STAGES = ("detect", "embed", "match", "mark", "frame")
+
+
+class Ticket:
+    """One admitted request; release() (idempotent) when its frames are done."""
+
+    def __init__(self, controller, frames, admitted, estimated_seconds, retry_after=None):
+        self.controller = controller
+        self.frames = frames
+        self.admitted = admitted
+        self.estimated_seconds = estimated_seconds
+        self.retry_after = retry_after
+        self._released = not admitted
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.controller._release(self.frames)
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn, record its duration as the "frame" stage and release (inline or on a job worker)."""
+        try:
+            with self.controller.stage("frame", self.frames):
+                return fn(*args, **kwargs)
+        finally:
+            self.release()
+
+
+class AdmissionController:
+
+    def __init__(self, deadline=ADMISSION_DEADLINE, concurrency=ADMISSION_CONCURRENCY,
+                 default_frame_seconds=ADMISSION_DEFAULT_FRAME_SECONDS, enabled=ADMISSION_CONTROL):
+        self.deadline = deadline
+        self.concurrency = max(1, concurrency)
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.timings = {stage: None for stage in STAGES}
+        self.timings["frame"] = default_frame_seconds
+        self.stats = {"admitted": 0, "rejected": 0}
+
+    def estimate(self, frames=1):
+        """Expected seconds until `frames` new frames would be processed, given the work in flight."""
+        frame_seconds = self.timings["frame"]
+        return frame_seconds * (frames + self.in_flight / float(self.concurrency))
+
+    def admit(self, frames=1, deadline=None):
+        """Admit `frames` frames, or return a rejected Ticket with retry_after (seconds)."""
+        deadline = self.deadline if deadline is None else deadline
+        with self._lock:
+            estimated = self.estimate(frames)
+            if self.enabled and self.in_flight > 0 and estimated > deadline:
+                self.stats["rejected"] += 1
+                # time for enough in-flight frames to drain so the estimate fits again
+                retry_after = max(1, math.ceil(estimated - deadline))
+                return Ticket(self, frames, False, estimated, retry_after)
+            self.in_flight += frames
+            self.stats["admitted"] += 1
+            return Ticket(self, frames, True, estimated)
+
+    def _release(self, frames):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - frames)
+
+    def record(self, stage, seconds, frames=1):
+        """Fold a measured stage duration (per frame) into its moving average."""
+        per_frame = seconds / float(max(1, frames))
+        with self._lock:
+            previous = self.timings.get(stage)
+            self.timings[stage] = per_frame if previous is None else (1 - EWMA_ALPHA) * previous + EWMA_ALPHA * per_frame
+
+    @contextmanager
+    def stage(self, name, frames=1):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, frames)
+
+    def status(self):
+        with self._lock:
+            return dict(self.stats,
+                        enabled=self.enabled,
+                        in_flight=self.in_flight,
+                        concurrency=self.concurrency,
+                        deadline=self.deadline,
+                        estimated_wait=round(self.estimate(0), 3),
+                        stage_seconds={k: (round(v, 4) if v is not None else None) for k, v in self.timings.items()})
+
+
+admission = AdmissionController()
@@ -0,0 +1,234 @@
+"""
+Approximate nearest-neighbour search for large (multi-campus) galleries.
+
+IVFFlatIndex is an inverted-file index with exact (flat) scoring inside each list, written in NumPy:
+- vectors are L2-normalized, so inner product == cosine similarity
+- a spherical k-means splits the gallery into `nlist` cells
+- a query is only scored against the vectors in its `nprobe` closest cells
+
+Raising nprobe trades latency for recall (nprobe == nlist is exact search).
+It exposes the same search(queries, k) / student_ids / __len__ interface as
+embeddings_comparator.Gallery, so match_students works with either.
+"""
+
+import os
+import numpy as np
+from embeddings_comparator import Gallery, l2_normalize, reserve_rows
+
+# Configuration (environment overrides)
+ANN_BACKEND = os.getenv("ANN_BACKEND", "exact").lower()          # "exact", "ivf" or "pgvector" (pgvector_index.py)
+ANN_NLIST = int(os.getenv("ANN_NLIST", "0"))                       # 0 = about sqrt(N) cells
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))                     # cells scored per query
+ANN_MIN_TRAIN = int(os.getenv("ANN_MIN_TRAIN", "10000"))           # below this, search stays exact
+KMEANS_ITERS = 10
+KMEANS_MAX_TRAIN_POINTS_PER_LIST = 64
+ASSIGN_CHUNK = 8192
+
+
+def spherical_kmeans(vectors, nlist, iters=KMEANS_ITERS, seed=0):
+    """Cluster L2-normalized vectors into nlist unit-norm centroids (cosine k-means)."""
+    rng = np.random.default_rng(seed)
+    n = len(vectors)
+    train = vectors
+    max_train = nlist * KMEANS_MAX_TRAIN_POINTS_PER_LIST
+    if n > max_train:
+        train = vectors[rng.choice(n, max_train, replace=False)]
+
+    centroids = train[rng.choice(len(train), nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = nearest_centroid(train, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, train)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # re-seed empty cells from random training points
+            sums[empty] = train[rng.choice(len(train), int(empty.sum()), replace=False)]
+        centroids = l2_normalize(sums)
+    return centroids
+
+def nearest_centroid(vectors, centroids):
+    """Index of the most similar centroid for each vector, computed in chunks to bound memory."""
+    out = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), ASSIGN_CHUNK):
+        block = vectors[start:start + ASSIGN_CHUNK]
+        out[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+class IVFFlatIndex:
+    """
+    Inverted-file index over the gallery. Supports incremental inserts via add() and deletes via
+    remove(); vectors added before training (fewer than min_train) are searched exactly.
+
+    Rows live in capacity-doubling buffers and each cell keeps its own buffer plus a fill count,
+    so add() costs O(rows added). copy() returns a new version that shares those buffers: the
+    copy appends past the lengths this version knows about and copies the (small) alive mask
+    before deleting, so searches on the old version are never affected. Only the newest version
+    may be extended (load_embeddings' refresher is the single writer).
+    """
+
+    def __init__(self, dim, nlist=ANN_NLIST, nprobe=ANN_NPROBE, min_train=ANN_MIN_TRAIN):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+        self.centroids = None
+        self.n = 0      # rows added so far (deleted rows included)
+        self.live = 0   # rows not removed
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.student_ids = np.zeros((0,), dtype=object)
+        self.alive = np.zeros((0,), dtype=bool)
+        # per cell: row ids into self.vectors, a contiguous copy of those vectors, and how many are filled
+        self.list_rows = []
+        self.list_vectors = []
+        self.list_sizes = []
+        self._exact = None
+
+    @classmethod
+    def from_gallery(cls, gallery, nlist=ANN_NLIST, nprobe=ANN_NPROBE, min_train=ANN_MIN_TRAIN):
+        """Index with the gallery's row numbering (rows the gallery masks out are removed)."""
+        dim = gallery.vectors.shape[1] if len(gallery) else 0
+        index = cls(dim, nlist=nlist, nprobe=nprobe, min_train=min_train)
+        if len(gallery):
+            index.add(gallery.vectors, gallery.student_ids)
+            if gallery.alive is not None:
+                index.remove(np.flatnonzero(~gallery.alive))
+        return index
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def __len__(self):
+        return self.live
+
+    def copy(self):
+        """A version that can be changed with add() / remove() without affecting this one."""
+        clone = object.__new__(IVFFlatIndex)
+        clone.__dict__.update(self.__dict__)
+        clone.list_rows = list(self.list_rows)
+        clone.list_vectors = list(self.list_vectors)
+        clone.list_sizes = list(self.list_sizes)
+        return clone
+
+    def train(self):
+        rows = np.flatnonzero(self.alive[:self.n])
+        nlist = self.nlist or max(1, int(round(np.sqrt(len(rows)))))
+        nlist = min(nlist, len(rows))
+        vectors = self.vectors[rows]
+        self.centroids = spherical_kmeans(vectors, nlist)
+        assign = nearest_centroid(vectors, self.centroids)
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(nlist + 1))
+        self.list_rows = [rows[order[bounds[c]:bounds[c + 1]]] for c in range(nlist)]
+        self.list_vectors = [np.ascontiguousarray(self.vectors[cell]) for cell in self.list_rows]
+        self.list_sizes = [len(cell) for cell in self.list_rows]
+
+    def add(self, vectors, student_ids):
+        """
+        Insert new reference vectors (e.g. embeddings for newly enrolled images).
+        Returns their row ids, which continue the numbering of earlier rows.
+        """
+        vectors = l2_normalize(np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim or np.shape(vectors)[-1]))
+        if not self.dim:
+            self.dim = vectors.shape[1]
+            self.vectors = self.vectors.reshape(0, self.dim)
+        start, end = self.n, self.n + len(vectors)
+        self.vectors = reserve_rows(self.vectors, end)
+        self.vectors[start:end] = vectors
+        self.student_ids = reserve_rows(self.student_ids, end)
+        self.student_ids[start:end] = np.asarray(student_ids, dtype=object)
+        self.alive = reserve_rows(self.alive, end)
+        self.alive[start:end] = True
+        self.n = end
+        self.live += len(vectors)
+        self._exact = None
+
+        if not self.trained:
+            if self.live >= self.min_train:
+                self.train()
+            return np.arange(start, end)
+
+        assign = nearest_centroid(vectors, self.centroids)
+        for c in np.unique(assign):
+            new_rows = start + np.flatnonzero(assign == c)
+            size = self.list_sizes[c]
+            grown = size + len(new_rows)
+            self.list_rows[c] = reserve_rows(self.list_rows[c], grown)
+            self.list_rows[c][size:grown] = new_rows
+            self.list_vectors[c] = reserve_rows(self.list_vectors[c], grown)
+            self.list_vectors[c][size:grown] = self.vectors[new_rows]
+            self.list_sizes[c] = grown
+        return np.arange(start, end)
+
+    def remove(self, rows):
+        """Delete rows (ids from add()); they stay in their cell but are skipped by search."""
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[self.alive[rows]]
+        if len(rows) == 0:
+            return
+        # copy first: earlier versions share this mask
+        self.alive = self.alive.copy()
+        self.alive[rows] = False
+        self.live -= len(rows)
+        self._exact = None
+
+    def search(self, queries, k=5):
+        """Same contract as Gallery.search: (scores, row indices), each (Q, k') by descending similarity."""
+        queries = np.asarray(queries, dtype=np.float32)
+        if not self.trained:
+            if self._exact is None:
+                alive = self.alive[:self.n]
+                self._exact = Gallery.from_normalized(self.vectors[:self.n], self.student_ids[:self.n], None,
+                                                      None if self.live == self.n else alive)
+            return self._exact.search(queries, k)
+
+        k = min(k, len(self))
+        if len(queries) == 0 or k == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=int)
+        queries = l2_normalize(queries.reshape(len(queries), -1))
+
+        nprobe = min(self.nprobe, len(self.centroids))
+        cell_sims = queries @ self.centroids.T
+        probes = np.argpartition(-cell_sims, nprobe - 1, axis=1)[:, :nprobe]
+
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=int)
+        for q, cells in enumerate(probes):
+            rows = np.concatenate([self.list_rows[c][:self.list_sizes[c]] for c in cells])
+            sims = np.concatenate([self.list_vectors[c][:self.list_sizes[c]] for c in cells]) @ queries[q]
+            if self.live < self.n:
+                keep = self.alive[rows]
+                rows, sims = rows[keep], sims[keep]
+            if len(rows) == 0:
+                continue
+            kk = min(k, len(rows))
+            top = np.argpartition(-sims, kk - 1)[:kk]
+            top = top[np.argsort(-sims[top], kind="stable")]
+            scores[q, :kk] = sims[top]
+            indices[q, :kk] = rows[top]
+        return scores, indices
+
+
+def build_global_index(gallery):
+    """Index used for institution-wide search: the exact Gallery, or an IVF index when ANN_BACKEND=ivf."""
+    if ANN_BACKEND == "ivf":
+        return IVFFlatIndex.from_gallery(gallery)
+    return gallery
+
+
+def update_global_index(index, gallery, new_rows, removed_rows):
+    """
+    The global index for gallery, a new version of `gallery` with new_rows appended and
+    removed_rows masked out. An IVF index is copied and updated in place of a rebuild
+    (no k-means retraining); the exact backend just searches the new gallery.
+    """
+    if not isinstance(index, IVFFlatIndex):
+        return gallery
+    index = index.copy()
+    index.remove(removed_rows)
+    added = index.add(gallery.vectors[new_rows], gallery.student_ids[new_rows])
+    if len(added) and added[0] != new_rows[0]:
+        raise ValueError("IVF index rows are out of step with the gallery")
+    return index
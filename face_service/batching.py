@@ -0,0 +1,168 @@
+"""
+Cross-request micro-batching for the face pipeline.
+
+Request threads submit frames (detection) or aligned face crops (recognition) and get a Future
+back; one dispatcher thread per stage collects whatever is queued into a micro-batch - up to
+max_batch_size items, waiting at most max_wait_ms after the first one - and runs a single batched
+forward pass for all callers. Faces are aligned (landmarker included) in the request thread, so
+the recognition dispatcher only runs the batched ArcFace call. When several classrooms upload at the same moment their frames share
+one YOLO / ArcFace call instead of running one after another. Batchers are per process, so
+under gunicorn only requests handled by the same worker share a batch.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from detector import detect_faces_batch
+from embeddings_generator import align_faces, embed_aligned_batch, embed_faces_batch, get_model
+
+INFER_BATCHING = os.getenv("INFER_BATCHING", "true").lower() == "true"
+DETECT_MAX_BATCH = int(os.getenv("DETECT_MAX_BATCH", "4"))          # frames per detection micro-batch
+DETECT_MAX_WAIT_MS = float(os.getenv("DETECT_MAX_WAIT_MS", "10"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH", "64"))           # faces per recognition micro-batch
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+BATCH_RESULT_TIMEOUT = float(os.getenv("BATCH_RESULT_TIMEOUT", "60"))  # seconds a request waits for its micro-batch
+
+
+class MicroBatcher:
+    """
+    fn(items) -> results (same length and order) is called on groups of submitted items.
+    The dispatcher thread starts on the first submit, so it is created in the process that
+    uses it (after a pre-fork server has forked).
+    """
+
+    def __init__(self, fn, max_batch_size, max_wait_ms, name="batcher"):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.stats = {"batches": 0, "items": 0, "max_batch": 0, "busy_seconds": 0.0, "errors": 0,
+                      "timeouts": 0}
+
+    def submit(self, item):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items, timeout=BATCH_RESULT_TIMEOUT):
+        """
+        Submit every item and wait for all results (in input order).
+        Raises TimeoutError when they are not all done within timeout seconds (a stuck forward
+        pass); items that are still queued are then cancelled and skipped by the dispatcher.
+        """
+        futures = [self.submit(item) for item in items]
+        deadline = time.monotonic() + timeout
+        try:
+            return [f.result(timeout=max(0.0, deadline - time.monotonic())) for f in futures]
+        except TimeoutError:
+            for f in futures:
+                f.cancel()
+            self.stats["timeouts"] += 1
+            raise TimeoutError(f"{self.name}: no result for {len(items)} items within {timeout}s")
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def status(self):
+        batches = self.stats["batches"]
+        return dict(self.stats,
+                    busy_seconds=round(self.stats["busy_seconds"], 3),
+                    avg_batch=round(self.stats["items"] / batches, 2) if batches else 0.0,
+                    avg_batch_seconds=round(self.stats["busy_seconds"] / batches, 4) if batches else 0.0,
+                    depth=self.depth(),
+                    max_batch_size=self.max_batch_size,
+                    max_wait_ms=self.max_wait * 1000.0)
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    # past the deadline, only take what is already queued
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # drop items whose caller gave up (cancelled) and mark the rest as running
+            batch = [(item, future) for item, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = list(self.fn(items))
+                if len(results) != len(batch):
+                    # results can no longer be matched to callers; fail the batch instead of
+                    # leaving futures unresolved or handing out someone else's result
+                    raise RuntimeError(f"{self.name}: {len(results)} results for a batch of {len(batch)}")
+            except Exception as e:
+                self.stats["errors"] += 1
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.stats["batches"] += 1
+                self.stats["items"] += len(items)
+                self.stats["max_batch"] = max(self.stats["max_batch"], len(items))
+                self.stats["busy_seconds"] += time.perf_counter() - start
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def _embed(aligned):
+    return list(embed_aligned_batch(get_model(), aligned))
+
+
+detection_batcher = MicroBatcher(detect_faces_batch, DETECT_MAX_BATCH, DETECT_MAX_WAIT_MS, name="detect-batcher")
+embedding_batcher = MicroBatcher(_embed, EMBED_MAX_BATCH, EMBED_MAX_WAIT_MS, name="embed-batcher")
+
+
+def detect_frames(images):
+    """detect_faces_batch for one request's frames, sharing forward passes with concurrent requests."""
+    if not INFER_BATCHING:
+        return detect_faces_batch(images)
+    faces_per_image = detection_batcher.map(images)
+    # frame_index was relative to the shared micro-batch; make it relative to this request
+    for frame_index, faces in enumerate(faces_per_image):
+        for face in faces:
+            face["frame_index"] = frame_index
+    return faces_per_image
+
+
+def embed_faces(model, faces):
+    """
+    embed_faces_batch replacement for generate_bulk_embeddings(embed_fn=...): faces are aligned
+    here, in the request thread, and only the 112x112 crops go through the shared micro-batch.
+    """
+    if not INFER_BATCHING:
+        return embed_faces_batch(model, faces)
+    return embedding_batcher.map(align_faces(model, faces))
+
+
+def status():
+    return {
+        "enabled": INFER_BATCHING,
+        "detection": detection_batcher.status(),
+        "embedding": embedding_batcher.status(),
+    }
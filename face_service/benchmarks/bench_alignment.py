@@ -0,0 +1,89 @@
+"""
+Accuracy check: aligning query faces from the YOLO box prior vs 106-point landmarker points.
+Enrollment embeddings come from FaceAnalysis.get (RetinaFace 5-point alignment), exactly as the
+web service builds them. Queries go through the serving path (YOLO detection + recognition-only
+embedding) twice, once per alignment mode, and are matched against all enrollments.
+
+Dataset layout (one folder per person, at least two photos each):
+    root/<person>/<photo>.jpg
+The first photo of each person (sorted by name) is enrolled, the others are queries.
+
+Run from face_service/ (needs the YOLO weights and the buffalo_l models):
+    python benchmarks/bench_alignment.py path/to/dataset
+"""
+
+import os
+import sys
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embeddings_generator
+from detector import detect_faces
+from embeddings_generator import get_model, generate_embedding, embed_faces_batch
+
+THRESHOLD = 0.4  # match_students default
+
+
+def load_dataset(root):
+    people = {}
+    for person in sorted(os.listdir(root)):
+        folder = os.path.join(root, person)
+        if os.path.isdir(folder):
+            photos = sorted(os.path.join(folder, f) for f in os.listdir(folder)
+                            if f.lower().endswith((".jpg", ".jpeg", ".png")))
+            if len(photos) >= 2:
+                people[person] = photos
+    return people
+
+
+def largest_face(image):
+    faces = detect_faces(image)
+    if not faces:
+        return None
+    return max(faces, key=lambda f: (f["box"][2] - f["box"][0]) * (f["box"][3] - f["box"][1]))
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def evaluate(query_embeddings, query_labels, enrolled, enrolled_labels):
+    scores = normalize(query_embeddings) @ normalize(enrolled).T
+    own = scores[np.arange(len(query_labels)), [enrolled_labels.index(p) for p in query_labels]]
+    best = [enrolled_labels[i] for i in scores.argmax(axis=1)]
+    return {
+        "genuine_cosine": float(own.mean()),
+        "rank1": float(np.mean([b == p for b, p in zip(best, query_labels)])),
+        "above_threshold": float(np.mean(own >= THRESHOLD)),
+    }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    people = load_dataset(sys.argv[1])
+    model = get_model()
+
+    enrolled, enrolled_labels = [], []
+    faces, query_labels = [], []
+    for person, photos in people.items():
+        embedding = generate_embedding(model, photos[0])
+        if embedding is None:
+            continue
+        enrolled.append(embedding)
+        enrolled_labels.append(person)
+        for path in photos[1:]:
+            face = largest_face(cv2.imread(path))
+            if face is not None:
+                faces.append(face)
+                query_labels.append(person)
+
+    print(f"{len(enrolled_labels)} people enrolled, {len(faces)} query faces")
+    print(f"{'alignment':>12} {'cosine':>7} {'rank-1':>7} {'>= ' + str(THRESHOLD):>7}")
+    for name, use_landmarks in (("box prior", False), ("landmarks", True)):
+        embeddings_generator.QUERY_LANDMARKS = use_landmarks
+        result = evaluate(embed_faces_batch(model, faces), query_labels, enrolled, enrolled_labels)
+        print(f"{name:>12} {result['genuine_cosine']:7.3f} {result['rank1']:7.1%} {result['above_threshold']:7.1%}")
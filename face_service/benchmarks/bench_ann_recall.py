@@ -0,0 +1,79 @@
+"""
+Benchmark: IVF-flat ANN index vs exact gallery search.
+Builds a synthetic gallery (students x images around per-student identity vectors),
+then reports recall@5 against exact search and per-query latency for several nprobe values.
+
+Run from face_service/:
+    python benchmarks/bench_ann_recall.py [num_students] [images_per_student]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from embeddings_comparator import Gallery
+from ann_index import IVFFlatIndex
+
+DIM = 512
+NUM_QUERIES = 200
+TOP_K = 5
+NPROBES = (1, 4, 8, 16, 32)
+
+
+def synthetic_gallery(num_students, images_per_student, seed=0):
+    rng = np.random.default_rng(seed)
+    identities = rng.normal(size=(num_students, DIM)).astype(np.float32)
+    noise = rng.normal(scale=0.6, size=(num_students, images_per_student, DIM)).astype(np.float32)
+    vectors = (identities[:, None, :] + noise).reshape(-1, DIM)
+    student_ids = np.repeat(np.arange(num_students), images_per_student)
+    # queries: fresh "photos" of random enrolled students
+    picks = rng.choice(num_students, NUM_QUERIES)
+    queries = identities[picks] + rng.normal(scale=0.6, size=(NUM_QUERIES, DIM)).astype(np.float32)
+    return Gallery(vectors, student_ids), queries
+
+def recall_at_k(exact_idx, approx_idx):
+    hits = [len(set(e) & set(a)) for e, a in zip(exact_idx.tolist(), approx_idx.tolist())]
+    return sum(hits) / float(exact_idx.size)
+
+
+if __name__ == "__main__":
+    num_students = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    images_per_student = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    gallery, queries = synthetic_gallery(num_students, images_per_student)
+    print(f"gallery: {len(gallery)} vectors ({num_students} students x {images_per_student}), {NUM_QUERIES} queries")
+
+    start = time.perf_counter()
+    _, exact_idx = gallery.search(queries, k=TOP_K)
+    t_exact = (time.perf_counter() - start) / NUM_QUERIES
+    print(f"exact search: {t_exact * 1e3:.3f} ms/query")
+
+    start = time.perf_counter()
+    index = IVFFlatIndex.from_gallery(gallery, min_train=0)
+    print(f"IVF build: {time.perf_counter() - start:.2f}s, nlist={len(index.centroids)}")
+
+    print(f"{'nprobe':>7} {'recall@5':>9} {'ms/query':>9}")
+    for nprobe in NPROBES:
+        index.nprobe = nprobe
+        start = time.perf_counter()
+        _, approx_idx = index.search(queries, k=TOP_K)
+        t_ivf = (time.perf_counter() - start) / NUM_QUERIES
+        print(f"{nprobe:>7} {recall_at_k(exact_idx, approx_idx):>9.3f} {t_ivf * 1e3:>9.3f}")
+
+    # a delta refresh: new version of the index, new images go straight into their nearest cell
+    # (amortized O(rows added)), deleted ones are masked out; no k-means retraining
+    # (the first add after a build grows the buffers once; later ones fill the spare capacity)
+    new_vectors = queries[:10]
+    updated = index
+    for label in ("first", "next"):
+        start = time.perf_counter()
+        updated = updated.copy()
+        updated.add(new_vectors, np.arange(10) + num_students)
+        print(f"{label} incremental add of {len(new_vectors)} vectors: "
+              f"{(time.perf_counter() - start) * 1e3:.2f} ms, size={len(updated)}")
+    start = time.perf_counter()
+    updated.remove(np.arange(10))
+    print(f"remove of 10 vectors: {(time.perf_counter() - start) * 1e3:.2f} ms, size={len(updated)}")
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark: pure-Python weighted_cluster + cv2 NMS vs the vectorized IoU-matrix versions.
+Generates synthetic TTA output (N faces x 6 TTA passes with jitter + some noise boxes),
+checks that both implementations produce the same merged boxes, and prints timings.
+
+Run from face_service/:
+    python benchmarks/bench_weighted_cluster.py
+"""
+
+import os
+import sys
+import time
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utilities.box_ops import weighted_cluster, weighted_cluster_vectorized, nms
+
+CLUSTER_IOU = 0.30
+CONF_THRESHOLD = 0.25
+NMS_IOU = 0.45
+TTA_PASSES = 6
+REPEATS = 5
+
+
+def synthetic_boxes(n_faces, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(50, 1550, size=(n_faces, 2))
+    sizes = rng.uniform(30, 90, size=(n_faces, 1))
+    boxes, confs = [], []
+    for _ in range(TTA_PASSES):
+        jitter = rng.normal(0, 3, size=(n_faces, 4))
+        b = np.hstack([centers - sizes / 2, centers + sizes / 2]) + jitter
+        boxes.append(b)
+        confs.append(rng.uniform(CONF_THRESHOLD, 0.95, size=n_faces))
+    # a few low-confidence false positives
+    noise = rng.uniform(0, 1500, size=(n_faces // 4, 2))
+    boxes.append(np.hstack([noise, noise + 40]))
+    confs.append(rng.uniform(CONF_THRESHOLD, 0.4, size=n_faces // 4))
+    boxes = np.rint(np.vstack(boxes)).astype(int)
+    return boxes, np.concatenate(confs)
+
+def legacy_pipeline(boxes, confs):
+    merged_boxes, merged_confs = weighted_cluster(boxes.tolist(), confs.tolist(), iou_thresh=CLUSTER_IOU)
+    boxes_xywh = [[b[0], b[1], b[2] - b[0] + 1, b[3] - b[1] + 1] for b in merged_boxes]
+    indices = cv2.dnn.NMSBoxes(boxes_xywh, merged_confs, CONF_THRESHOLD, NMS_IOU)
+    idxs = [int(i[0]) if isinstance(i, (list, tuple, np.ndarray)) else int(i) for i in indices]
+    return merged_boxes, sorted(tuple(merged_boxes[i]) for i in idxs)
+
+def vectorized_pipeline(boxes, confs):
+    merged_boxes, merged_confs = weighted_cluster_vectorized(boxes, confs, iou_thresh=CLUSTER_IOU)
+    keep = nms(merged_boxes, merged_confs, CONF_THRESHOLD, NMS_IOU)
+    return merged_boxes.tolist(), sorted(tuple(b) for b in merged_boxes[keep].tolist())
+
+def best_time(fn, *args):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    print(f"{'faces':>6} {'boxes':>6} {'legacy ms':>10} {'vector ms':>10} {'speedup':>8}  same")
+    for n_faces in (10, 40, 80, 160):
+        boxes, confs = synthetic_boxes(n_faces)
+        legacy_merged, legacy_final = legacy_pipeline(boxes, confs)
+        vector_merged, vector_final = vectorized_pipeline(boxes, confs)
+        same = legacy_merged == vector_merged and legacy_final == vector_final
+
+        t_legacy = best_time(legacy_pipeline, boxes, confs)
+        t_vector = best_time(vectorized_pipeline, boxes, confs)
+        print(f"{n_faces:>6} {len(boxes):>6} {t_legacy * 1e3:>10.2f} {t_vector * 1e3:>10.2f} "
+              f"{t_legacy / t_vector:>7.1f}x  {same}")
@@ -10,9 +10,10 @@ You must download a pretrained "face" YOLOv8 weight file and set MODEL_PATH belo
 
 from pathlib import Path
 import sys
+import threading
 import cv2
 import numpy as np
-from utilities.image_path import get_temp_image_path
+from utilities.box_ops import iou_matrix, weighted_cluster_vectorized, nms
 from ultralytics import YOLO
 import torch
 
@@ -22,6 +23,10 @@ MODEL_PATH = "models/yolov8x-face-lindevs.pt"        # set to your downloaded YO
 OUTPUT_PATH = "detection_yolov8_faces.jpg"
 
 model = YOLO(MODEL_PATH)
+model.fuse()  # fuse conv+bn once at load, so pre-forked workers share the fused weights
+# the ultralytics predictor keeps per-call state on the model and is not thread-safe;
+# every forward pass (request threads, job workers, the detection batcher) goes through _predict
+_predict_lock = threading.Lock()
 
 SCALES = [1.0, 1.5, 2.0]              # TTA scales (1.0 = original). Add more for tiny faces.
 USE_FLIP = True                       # horizontal flip TTA
@@ -29,61 +34,180 @@ CONF_THRESHOLD = 0.25                 # keep low to increase recall, then rely o
 NMS_IOU = 0.45                        # final NMS threshold
 CLUSTER_IOU = 0.30                    # clustering IoU to merge many TTA boxes
 IMG_MAX_SIDE = 1600                   # resize longer side to avoid huge inputs (keeps aspect ratio)
+IMGSZ = 1280                          # inference size; every TTA variant is letterboxed to IMGSZ x IMGSZ
+BATCH_TTA = True                      # run all TTA variants as one batched forward pass
+DETECT_BATCH_SIZE = 12                # max letterboxed images per forward pass (multi-frame bursts)
+KPT_FLIP_ORDER = [1, 0, 2, 4, 3]      # 5-point face keypoint order after a horizontal flip
 
 
-def iou(a, b):
-    x1 = max(a[0], b[0]); y1 = max(a[1], b[1])
-    x2 = min(a[2], b[2]); y2 = min(a[3], b[3])
-    w = max(0, x2 - x1 + 1); h = max(0, y2 - y1 + 1)
-    inter = w * h
-    area_a = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
-    area_b = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
-    union = area_a + area_b - inter
-    return inter / union if union > 0 else 0.0
+def letterbox(img, size, color=(114, 114, 114)):
+    """
+    Resize img to fit inside a size x size canvas (keeping aspect ratio) and pad the rest.
+    Returns the padded image, the resize gain and the (left, top) padding.
+    """
+    h, w = img.shape[:2]
+    gain = min(size / float(h), size / float(w))
+    new_w, new_h = int(round(w * gain)), int(round(h * gain))
+    if (new_w, new_h) != (w, h):
+        img = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    dw, dh = (size - new_w) / 2.0, (size - new_h) / 2.0
+    top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
+    left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    padded = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+    return padded, gain, (left, top)
 
-def weighted_cluster(boxes, confs, iou_thresh=0.3):
+def build_tta_variants(img_proc):
     """
-    Cluster boxes by IoU >= iou_thresh. For each cluster compute confidence-weighted average box.
-    Returns merged_boxes (xyxy ints) and merged_confs (floats).
+    Build every (scale, flip) TTA variant of img_proc.
+    Returns a list of dicts: {"image", "scale_shape", "flip"}.
     """
-    if not boxes:
-        return [], []
-    boxes = [list(b) for b in boxes]
-    confs = [float(c) for c in confs]
-    idxs = list(range(len(boxes)))
-    merged_boxes = []
-    merged_confs = []
-    while idxs:
-        # pick index of highest confidence remaining
-        seed = max(idxs, key=lambda i: confs[i])
-        cluster = [seed]
-        others = [i for i in idxs if i != seed]
-        for j in others:
-            if iou(boxes[seed], boxes[j]) >= iou_thresh:
-                cluster.append(j)
-        # weighted average
-        weights = np.array([confs[i] for i in cluster], dtype=float)
-        coords = np.array([boxes[i] for i in cluster], dtype=float)
-        wsum = weights.sum() if weights.sum() > 0 else 1.0
-        avg = (weights[:, None] * coords).sum(axis=0) / wsum
-        x1, y1, x2, y2 = avg
-        merged_boxes.append([int(round(x1)), int(round(y1)), int(round(x2)), int(round(y2))])
-        merged_confs.append(float(max(confs[i] for i in cluster)))
-        # remove clustered indices
-        idxs = [i for i in idxs if i not in cluster]
-    return merged_boxes, merged_confs
+    variants = []
+    for scale in SCALES:
+        if scale == 1.0:
+            img_scale = img_proc
+        else:
+            sw = int(round(img_proc.shape[1] * scale))
+            sh = int(round(img_proc.shape[0] * scale))
+            img_scale = cv2.resize(img_proc, (sw, sh), interpolation=cv2.INTER_LINEAR)
 
-# ---------- Detection pipeline ----------
-def detect_faces(image):
+        for flip in (False, True) if USE_FLIP else (False,):
+            img_in = cv2.flip(img_scale, 1) if flip else img_scale
+            variants.append({"image": img_in, "scale_shape": img_scale.shape[:2], "flip": flip})
+    return variants
 
-    # choose device
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"[INFO] Using device: {device}")
+def map_boxes_back(boxes, variant, proc_shape, orig_shape, kpts=None):
+    """
+    Vectorized mapping of Nx4 xyxy boxes from a TTA variant back to original image coordinates.
+    Unflips, undoes the TTA scale and the IMG_MAX_SIDE resize, rounds, clips and drops empty boxes.
+    If Nx5x2 face keypoints are given they are mapped the same way (left/right swapped on flip)
+    and returned as a third value.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4).copy()
+    scale_h, scale_w = variant["scale_shape"]
+    proc_h, proc_w = proc_shape
+    orig_h, orig_w = orig_shape
 
-    model.fuse()  # fuse conv+bn for faster inference
+    if variant["flip"]:
+        # unflip relative to img_scale width
+        boxes[:, [0, 2]] = scale_w - boxes[:, [2, 0]]
+    # img_scale -> img_proc -> original image
+    sx = (proc_w / float(scale_w)) * (orig_w / float(proc_w))
+    sy = (proc_h / float(scale_h)) * (orig_h / float(proc_h))
+    boxes *= np.array([sx, sy, sx, sy])
 
-    # load image and keep original
-    img_bgr = image
+    # round + clip
+    boxes = np.rint(boxes).astype(int)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, orig_w - 1)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, orig_h - 1)
+    keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    if kpts is None:
+        return boxes[keep], keep
+
+    kpts = np.asarray(kpts, dtype=float).reshape(-1, 5, 2).copy()
+    if variant["flip"]:
+        kpts[:, :, 0] = scale_w - kpts[:, :, 0]
+        # left eye <-> right eye, left mouth corner <-> right mouth corner
+        kpts = kpts[:, KPT_FLIP_ORDER]
+    kpts *= np.array([sx, sy])
+    return boxes[keep], keep, kpts[keep]
+
+def _result_arrays(r):
+    # r.boxes.xyxy -> tensor Nx4, r.boxes.conf -> Nx1, r.keypoints.xy -> Nx5x2 (pose-style face models only)
+    if r.boxes is None:
+        return np.zeros((0, 4)), np.zeros((0,)), np.full((0, 5, 2), np.nan)
+    boxes = r.boxes.xyxy.cpu().numpy()
+    confs = r.boxes.conf.cpu().numpy().flatten()
+    kpts = getattr(r, "keypoints", None)
+    if kpts is not None and kpts.xy is not None and tuple(kpts.xy.shape[1:]) == (5, 2):
+        kpts = kpts.xy.cpu().numpy().astype(float)
+    else:
+        kpts = np.full((len(boxes), 5, 2), np.nan)
+    return boxes, confs, kpts
+
+def _predict(source, device):
+    with _predict_lock:
+        return model.predict(source=source, device=device, conf=CONF_THRESHOLD, imgsz=IMGSZ, verbose=False, augment=False)
+
+def _predict_sequential(variants, proc_shape, orig_shape, device):
+    """One model.predict call per TTA variant."""
+    all_boxes, all_confs, all_kpts = [], [], []
+    for variant in variants:
+        # inference: use model.predict for more options; set conf and imgsz high enough
+        # augment=False because we explicitly handle TTA
+        results = _predict(variant["image"], device)
+        # results is a list; take first (single image)
+        if not results:
+            continue
+        boxes, confs, kpts = _result_arrays(results[0])
+        boxes, keep, kpts = map_boxes_back(boxes, variant, proc_shape, orig_shape, kpts)
+        all_boxes.append(boxes)
+        all_confs.append(confs[keep])
+        all_kpts.append(kpts)
+    return _concat(all_boxes, all_confs, all_kpts)
+
+def _predict_batched(variants, proc_shape, orig_shape, device):
+    """
+    Letterbox every TTA variant to a shared IMGSZ x IMGSZ canvas and run them as one batch.
+    """
+    return _predict_batched_multi([(variants, proc_shape, orig_shape)], device)[0]
+
+def _predict_batched_multi(items, device):
+    """
+    Batched inference over the TTA variants of several images.
+    items: list of (variants, proc_shape, orig_shape); all variants are letterboxed to IMGSZ x IMGSZ
+    and sent through the model DETECT_BATCH_SIZE at a time.
+    Returns one (boxes, confs, kpts) tuple per item, in original image coordinates.
+    """
+    batch = []
+    owners = []
+    for item_idx, (variants, proc_shape, orig_shape) in enumerate(items):
+        for variant in variants:
+            padded, gain, (left, top) = letterbox(variant["image"], IMGSZ)
+            batch.append(padded)
+            owners.append((item_idx, variant, gain, left, top))
+
+    results = []
+    for start in range(0, len(batch), DETECT_BATCH_SIZE):
+        results.extend(_predict(batch[start:start + DETECT_BATCH_SIZE], device) or [])
+
+    per_item = [([], [], []) for _ in items]
+    for (item_idx, variant, gain, left, top), r in zip(owners, results):
+        _, proc_shape, orig_shape = items[item_idx]
+        boxes, confs, kpts = _result_arrays(r)
+        # letterbox canvas -> variant coordinates
+        boxes = (boxes - np.array([left, top, left, top])) / gain
+        kpts = (kpts - np.array([left, top])) / gain
+        boxes, keep, kpts = map_boxes_back(boxes, variant, proc_shape, orig_shape, kpts)
+        all_boxes, all_confs, all_kpts = per_item[item_idx]
+        all_boxes.append(boxes)
+        all_confs.append(confs[keep])
+        all_kpts.append(kpts)
+    return [_concat(*arrays) for arrays in per_item]
+
+def _concat(all_boxes, all_confs, all_kpts):
+    if not all_boxes:
+        return np.zeros((0, 4), dtype=int), np.zeros((0,)), np.full((0, 5, 2), np.nan)
+    return np.concatenate(all_boxes), np.concatenate(all_confs).astype(float), np.concatenate(all_kpts)
+
+def assign_keypoints(final_boxes, raw_boxes, raw_confs, raw_kpts):
+    """
+    Pick 5-point landmarks for each final (merged) box from the raw TTA detection that overlaps it best
+    (IoU x confidence). Returns a Kx5x2 array; rows are NaN when no overlapping detection had keypoints.
+    """
+    final_kpts = np.full((len(final_boxes), 5, 2), np.nan)
+    has_kpts = ~np.isnan(raw_kpts).any(axis=(1, 2))
+    if len(final_boxes) == 0 or not has_kpts.any():
+        return final_kpts
+    ious = iou_matrix(final_boxes, raw_boxes[has_kpts])
+    score = np.where(ious >= CLUSTER_IOU, ious * raw_confs[has_kpts], -1.0)
+    best = score.argmax(axis=1)
+    matched = score[np.arange(len(final_boxes)), best] > 0
+    final_kpts[matched] = raw_kpts[has_kpts][best[matched]]
+    return final_kpts
+
+# ---------- Detection pipeline ----------
+def _processing_image(img_bgr):
+    """Resize to IMG_MAX_SIDE (keeping aspect ratio) when the input is larger."""
     orig_h, orig_w = img_bgr.shape[:2]
     long_side = max(orig_h, orig_w)
     # optionally resize to limit input size while keeping aspect ratio
@@ -91,103 +215,87 @@ def detect_faces(image):
         scale_small = IMG_MAX_SIDE / float(long_side)
         new_w = int(round(orig_w * scale_small))
         new_h = int(round(orig_h * scale_small))
-        img_proc = cv2.resize(img_bgr, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
         print(f"[INFO] Resized input from ({orig_w},{orig_h}) -> ({new_w},{new_h}) to limit max side to {IMG_MAX_SIDE}")
-    else:
-        img_proc = img_bgr.copy()
-
-    all_boxes = []
-    all_confs = []
+        return cv2.resize(img_bgr, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    return img_bgr.copy()
 
-    # TTA: scales and flips
-    for scale in SCALES:
-        if scale == 1.0:
-            img_scale = img_proc
-        else:
-            sw = int(round(img_proc.shape[1] * scale))
-            sh = int(round(img_proc.shape[0] * scale))
-            img_scale = cv2.resize(img_proc, (sw, sh), interpolation=cv2.INTER_LINEAR)
+def _faces_from_detections(img_bgr, all_boxes, all_confs, all_kpts):
+    """Cluster + NMS the raw TTA detections of one image and crop the final faces."""
+    orig_h, orig_w = img_bgr.shape[:2]
+    if len(all_boxes) == 0:
+        print("[INFO] No faces detected")
+        return []
 
-        for flip in (False, True) if USE_FLIP else (False,):
-            if flip:
-                img_in = cv2.flip(img_scale, 1)
-            else:
-                img_in = img_scale
-
-            # inference: use model.predict for more options; set conf and imgsz high enough
-            # augment=False because we explicitly handle TTA
-            results = model.predict(source=img_in, device=device, conf=CONF_THRESHOLD, imgsz=1280, verbose=False, augment=False)
-            # results is a list; take first (single image)
-            if not results:
-                continue
-            r = results[0]
-            # r.boxes.xyxy -> tensor Nx4, r.boxes.conf -> Nx1
-            boxes = r.boxes.xyxy.cpu().numpy() if r.boxes is not None else np.zeros((0,4))
-            confs = r.boxes.conf.cpu().numpy().flatten() if r.boxes is not None else np.zeros((0,))
-
-            # map boxes back to coordinates in img_proc (because we may have resized img_proc earlier)
-            # and then back to original image coordinates if we resized for IMG_MAX_SIDE
-            # Step 1: if flipped, unflip
-            for (b, c) in zip(boxes, confs):
-                x1, y1, x2, y2 = b.astype(float)
-                if flip:
-                    # unflip relative to img_scale width
-                    w_img = img_in.shape[1]
-                    x1n = w_img - x2
-                    x2n = w_img - x1
-                    x1, x2 = x1n, x2n
-                # if img_scale != img_proc, scale coordinates back to img_proc
-                if img_scale.shape[1] != img_proc.shape[1] or img_scale.shape[0] != img_proc.shape[0]:
-                    sx = img_proc.shape[1] / float(img_scale.shape[1])
-                    sy = img_proc.shape[0] / float(img_scale.shape[0])
-                    x1 *= sx; x2 *= sx; y1 *= sy; y2 *= sy
-                # if img_proc was resized from original due to IMG_MAX_SIDE, scale coords up
-                if img_proc.shape[1] != orig_w or img_proc.shape[0] != orig_h:
-                    sx2 = orig_w / float(img_proc.shape[1])
-                    sy2 = orig_h / float(img_proc.shape[0])
-                    x1 *= sx2; x2 *= sx2; y1 *= sy2; y2 *= sy2
-                # clip
-                x1c = max(0, min(orig_w - 1, int(round(x1))))
-                y1c = max(0, min(orig_h - 1, int(round(y1))))
-                x2c = max(0, min(orig_w - 1, int(round(x2))))
-                y2c = max(0, min(orig_h - 1, int(round(y2))))
-                if x2c <= x1c or y2c <= y1c:
-                    continue
-                all_boxes.append([x1c, y1c, x2c, y2c])
-                all_confs.append(float(c))
+    # cluster and merge (one pairwise IoU matrix, array-based weighted merge)
+    merged_boxes, merged_confs = weighted_cluster_vectorized(all_boxes, all_confs, iou_thresh=CLUSTER_IOU)
 
-    if not all_boxes:
-        return {"message": "No faces detected"}
-
-    # cluster and merge
-    merged_boxes, merged_confs = weighted_cluster(all_boxes, all_confs, iou_thresh=CLUSTER_IOU)
-
-    # final NMS (cv2.dnn.NMSBoxes expects boxes in x,y,w,h)
-    boxes_xywh = [[b[0], b[1], b[2] - b[0] + 1, b[3] - b[1] + 1] for b in merged_boxes]
-    indices = cv2.dnn.NMSBoxes(boxes_xywh, merged_confs, CONF_THRESHOLD, NMS_IOU)
-    final_boxes = []
-    final_confs = []
-    if len(indices) > 0:
-        # handle OpenCV return formats
-        if isinstance(indices[0], (list, tuple, np.ndarray)):
-            idxs = [int(i[0]) for i in indices]
-        else:
-            idxs = [int(i) for i in indices]
-        for i in idxs:
-            final_boxes.append(merged_boxes[i])
-            final_confs.append(merged_confs[i])
+    # final NMS on the merged boxes
+    keep = nms(merged_boxes, merged_confs, CONF_THRESHOLD, NMS_IOU)
+    final_boxes = merged_boxes[keep].tolist()
+    final_confs = merged_confs[keep].tolist()
+    # 5-point landmarks (when the YOLO-face weights predict them) for recognition-only alignment
+    final_kpts = assign_keypoints(merged_boxes[keep], all_boxes, all_confs, all_kpts)
 
    # Crop faces from original image
     faces = []
-    for (box, conf) in zip(final_boxes, final_confs):
+    for (box, conf, kpts) in zip(final_boxes, final_confs, final_kpts):
         x1, y1, x2, y2 = box
         # ensure valid slice ranges
         y1s, y2s = max(0, y1), min(orig_h, y2 + 1)
         x1s, x2s = max(0, x1), min(orig_w, x2 + 1)
-        crop = img_bgr[y1s:y2s, x1s:x2s].copy()
-        image_path = get_temp_image_path()
-        cv2.imwrite(image_path, crop)
-        faces.append({"image_path": image_path, "file_id": None})
+        # zero-copy view into the decoded frame; handed straight to the embedder
+        crop = img_bgr[y1s:y2s, x1s:x2s]
+        faces.append({
+            "image": crop,
+            "frame": img_bgr,
+            "box": box,
+            "conf": conf,
+            "kpts": None if np.isnan(kpts).any() else kpts,
+            "file_id": None,
+        })
 
     return faces
 
+def detect_faces(image):
+
+    # choose device
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"[INFO] Using device: {device}")
+
+    # load image and keep original
+    img_bgr = image
+    img_proc = _processing_image(img_bgr)
+    variants = build_tta_variants(img_proc)
+
+    if BATCH_TTA:
+        all_boxes, all_confs, all_kpts = _predict_batched(variants, img_proc.shape[:2], img_bgr.shape[:2], device)
+    else:
+        all_boxes, all_confs, all_kpts = _predict_sequential(variants, img_proc.shape[:2], img_bgr.shape[:2], device)
+
+    return _faces_from_detections(img_bgr, all_boxes, all_confs, all_kpts)
+
+def detect_faces_batch(images):
+    """
+    detect_faces for several frames (e.g. a capture burst) with the TTA variants of all
+    frames batched together. Returns one face list per image, each face tagged with "frame_index".
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"[INFO] Using device: {device} for {len(images)} frames")
+
+    items = []
+    for img_bgr in images:
+        img_proc = _processing_image(img_bgr)
+        items.append((build_tta_variants(img_proc), img_proc.shape[:2], img_bgr.shape[:2]))
+
+    if BATCH_TTA:
+        detections = _predict_batched_multi(items, device)
+    else:
+        detections = [_predict_sequential(*item, device) for item in items]
+
+    faces_per_image = []
+    for frame_index, (img_bgr, (all_boxes, all_confs, all_kpts)) in enumerate(zip(images, detections)):
+        faces = _faces_from_detections(img_bgr, all_boxes, all_confs, all_kpts)
+        for face in faces:
+            face["frame_index"] = frame_index
+        faces_per_image.append(faces)
+    return faces_per_image
@@ -1,39 +1,212 @@
 import numpy as np
-from collections import defaultdict
+from collections import Counter, defaultdict
+from utilities.box_ops import iou_matrix
 
 
-def cosine_similarity(a, b):
-    a = np.array(a)
-    b = np.array(b)
-    return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+def l2_normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
 
 
-def find_top5_matches(test_embedding, db_embeddings):
+def reserve_rows(array, size):
+    """
+    array itself if it has at least size rows, else a copy with room for max(size, 2x) rows.
+    Appending into the spare rows keeps inserts amortized O(rows added) instead of O(N) per insert.
+    """
+    if size <= len(array):
+        return array
+    grown = np.empty((max(size, 2 * len(array), 16),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+class Gallery:
+    """
+    Reference embeddings as one contiguous, L2-normalized float32 matrix
+    with parallel arrays of student ids and class ids (one row per reference image).
+    alive optionally masks out deleted rows: they are never returned and not counted by len().
+    """
+
+    def __init__(self, vectors, student_ids, class_ids=None, alive=None):
+        self.vectors = np.ascontiguousarray(l2_normalize(vectors))
+        self.student_ids = np.asarray(student_ids)
+        self.class_ids = np.asarray(class_ids if class_ids is not None else [None] * len(self.student_ids), dtype=object)
+        self._set_alive(alive)
+
+    @classmethod
+    def from_normalized(cls, vectors, student_ids, class_ids, alive=None):
+        """Wrap arrays that are already L2-normalized as they are (views stay views, nothing is copied)."""
+        gallery = cls.__new__(cls)
+        gallery.vectors = vectors
+        gallery.student_ids = student_ids
+        gallery.class_ids = class_ids
+        gallery._set_alive(alive)
+        return gallery
+
+    def _set_alive(self, alive):
+        self.alive = alive
+        self._size = len(self.student_ids) if alive is None else int(np.count_nonzero(alive))
+
+    @classmethod
+    def from_dict(cls, db_embeddings, student_classes=None):
+        """
+        Build from {student_id: [embedding, ...]} (the load_embeddings format).
+        student_classes optionally maps student_id -> class_id.
+        """
+        student_classes = student_classes or {}
+        vectors = []
+        student_ids = []
+        class_ids = []
+        for student_id, emb_list in (db_embeddings or {}).items():
+            for emb in emb_list:
+                vectors.append(np.asarray(emb, dtype=np.float32))
+                student_ids.append(student_id)
+                class_ids.append(student_classes.get(student_id))
+        if not vectors:
+            return cls(np.zeros((0, 0), dtype=np.float32), [])
+        return cls(np.stack(vectors), student_ids, class_ids)
+
+    def subset(self, rows):
+        return Gallery.from_normalized(self.vectors[rows], self.student_ids[rows], self.class_ids[rows])
+
+    def by_class(self):
+        """Split into {class_id: Gallery}; rows without a class (or deleted) are left out."""
+        shards = {}
+        for class_id in set(self.class_ids.tolist()):
+            if class_id is None:
+                continue
+            in_class = self.class_ids == class_id
+            if self.alive is not None:
+                in_class &= self.alive
+            if in_class.any():
+                shards[class_id] = self.subset(np.flatnonzero(in_class))
+        return shards
+
+    def __len__(self):
+        return self._size
+
+    def search(self, queries, k=5):
+        """
+        Score all query embeddings against the gallery with one matrix multiply.
+        Returns (scores, indices), each (Q, k') sorted by descending cosine similarity,
+        where k' = min(k, len(gallery)).
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self))
+        if len(queries) == 0 or k == 0:
+            return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=int)
+        queries = l2_normalize(queries.reshape(len(queries), -1))
+
+        sims = queries @ self.vectors.T
+        if self.alive is not None:
+            sims[:, ~self.alive] = -np.inf
+        if k < sims.shape[1]:
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        else:
+            top = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+        top_scores = np.take_along_axis(sims, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind="stable")
+        return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+class ClassPartitionedGallery:
+    """
+    The global gallery sharded by Student.class_id, so a classroom frame is only
+    searched against students enrolled in that class.
+    """
+
+    def __init__(self, gallery, fallback_to_global=False, global_index=None, shards=None):
+        # global_index: optional ANN index over the same vectors, used for the fallback search
+        # shards: {class_id: Gallery} when the caller already split the gallery by class
+        self.global_gallery = global_index if global_index is not None else gallery
+        self.shards = shards if shards is not None else gallery.by_class()
+        self.fallback_to_global = fallback_to_global
+        self._empty = Gallery.from_dict({})
+
+    def updated(self, shards, global_index):
+        """Copy with {class_id: Gallery, or None to drop the class} shards replaced; the others are shared."""
+        clone = object.__new__(ClassPartitionedGallery)
+        clone.__dict__.update(self.__dict__)
+        clone.global_gallery = global_index
+        clone.shards = dict(self.shards)
+        for class_id, shard in shards.items():
+            if shard is None:
+                clone.shards.pop(class_id, None)
+            else:
+                clone.shards[class_id] = shard
+        return clone
+
+    def for_class(self, class_id):
+        """
+        Gallery to search for class_id. Falls back to the global gallery only when
+        fallback_to_global is set and the class has no shard.
+        """
+        try:
+            class_id = int(class_id)
+        except (TypeError, ValueError):
+            pass
+        shard = self.shards.get(class_id)
+        if shard is not None:
+            return shard
+        return self.global_gallery if self.fallback_to_global else self._empty
 
-    all_scores = []
 
-    for student_id, emb_list in db_embeddings.items():
-        for emb in emb_list:
-            sim = cosine_similarity(test_embedding, emb)
-            all_scores.append((sim, student_id))
+def as_gallery(db_embeddings):
+    # Gallery, ann_index.IVFFlatIndex, pgvector_index.PgVectorGallery, or anything else with search()/student_ids
+    if hasattr(db_embeddings, "search") or hasattr(db_embeddings, "search_students"):
+        return db_embeddings
+    return Gallery.from_dict(db_embeddings)
 
-    all_scores.sort(key=lambda x: x[0], reverse=True)
-    return all_scores[:5]
+
+def is_empty(gallery):
+    """True if the gallery has no reference vectors; database-backed galleries answer with is_empty()."""
+    if hasattr(gallery, "is_empty"):
+        return gallery.is_empty()
+    return len(gallery) == 0
+
+
+def search_students(gallery, queries, k=5):
+    """
+    Top-k (scores, student_ids) per query as lists, best first.
+    Backends that resolve student ids themselves (pgvector) provide search_students();
+    in-memory indexes map row indices through gallery.student_ids (-1 = no match).
+    """
+    if hasattr(gallery, "search_students"):
+        return gallery.search_students(queries, k)
+    scores, indices = gallery.search(queries, k)
+    found = indices >= 0
+    return ([row[f].tolist() for row, f in zip(scores, found)],
+            [gallery.student_ids[row[f]].tolist() for row, f in zip(indices, found)])
+
+
+def find_top5_matches(test_embedding, db_embeddings):
+
+    scores, student_ids = search_students(as_gallery(db_embeddings), [test_embedding], k=5)
+    return list(zip(scores[0], student_ids[0]))
 
 
 def match_students(test_embeddings, db_embeddings, threshold=0.4):
+    """
+    db_embeddings: a Gallery (or ANN / pgvector index), or {student_id: [embedding, ...]}.
+    Each test face votes with its top-5 gallery matches above threshold.
+    """
 
     predicted_students = []
     similar_students_all = []
-    print(test_embeddings)
 
-    for idx, test_emb in enumerate(test_embeddings):
-        top5 = find_top5_matches(test_emb, db_embeddings)
+    if len(test_embeddings) == 0:
+        return [], []
+
+    scores, top_ids = search_students(as_gallery(db_embeddings), test_embeddings, k=5)
+
+    for face_scores, face_ids in zip(scores, top_ids):
 
         vote_count = defaultdict(int)
         similar_students = []
 
-        for sim, stid in top5:
+        for sim, stid in zip(face_scores, face_ids):
             if sim >= threshold:
                 vote_count[stid] += 1
                 similar_students.append(stid)
@@ -48,3 +221,69 @@ def match_students(test_embeddings, db_embeddings, threshold=0.4):
         predicted_students.append(best_match)
 
     return predicted_students, similar_students_all
+
+
+def fuse_frame_matches(frame_indices, boxes, predicted_students, similar_students_all, min_frames=None,
+                       frames=None, iou_threshold=0.3):
+    """
+    Fuse per-face matches from several frames of the same scene (a capture burst).
+    frame_indices[i] / boxes[i] are the frame and xyxy box of face i; predicted_students /
+    similar_students_all come from match_students over all faces at once.
+
+    Faces are linked across frames into tracks: frame by frame, each face joins the track whose
+    last box overlaps it most (IoU >= iou_threshold, one face per track per frame), otherwise it
+    starts a new track. A track takes the student most of its faces were predicted as, and that
+    student is kept when the track saw them in at least min_frames frames (default: a majority of
+    the burst, ceil(frames / 2), with frames defaulting to the highest frame index + 1).
+    A one-off false match in a single frame therefore no longer marks a student.
+    Returns [{"student_id", "frames", "votes"}] sorted by frames, then top-5 votes.
+    """
+    if frames is None:
+        frames = max(frame_indices, default=-1) + 1
+    if min_frames is None or min_frames <= 0:
+        min_frames = (frames + 1) // 2
+
+    by_frame = defaultdict(list)
+    for i, frame_index in enumerate(frame_indices):
+        by_frame[frame_index].append(i)
+
+    tracks = []  # lists of face indices, at most one per frame
+    for frame_index in sorted(by_frame):
+        faces = by_frame[frame_index]
+        if tracks:
+            overlaps = iou_matrix([boxes[i] for i in faces], [boxes[track[-1]] for track in tracks])
+        else:
+            overlaps = np.zeros((len(faces), 0))
+        assigned = [None] * len(faces)
+        # greedy assignment, best overlap first
+        for flat in np.argsort(overlaps, axis=None)[::-1]:
+            f, t = np.unravel_index(flat, overlaps.shape)
+            if overlaps[f, t] < iou_threshold:
+                break
+            if assigned[f] is None and t not in assigned:
+                assigned[f] = t
+        for f, t in enumerate(assigned):
+            if t is None:
+                tracks.append([faces[f]])
+            else:
+                tracks[t].append(faces[f])
+
+    fused = {}
+    for track in tracks:
+        predictions = [predicted_students[i] for i in track if predicted_students[i] is not None]
+        if not predictions:
+            continue
+        counts = Counter(predictions)
+        stid, seen = counts.most_common(1)[0]
+        if seen < min_frames:
+            continue
+        votes = sum(1 for i in track if predicted_students[i] == stid
+                    for similar in similar_students_all[i] if similar == stid)
+        match = fused.setdefault(stid, {"student_id": stid, "frames": 0, "votes": 0})
+        # the same student on two tracks (e.g. they moved a lot): keep the best track's frames
+        match["frames"] = max(match["frames"], seen)
+        match["votes"] += votes
+
+    fused = list(fused.values())
+    fused.sort(key=lambda m: (m["frames"], m["votes"]), reverse=True)
+    return fused
@@ -1,7 +1,35 @@
+import os
+import threading
+import time
 import cv2
 import numpy as np
 import onnxruntime as ort
 from insightface.app import FaceAnalysis
+from insightface.utils import face_align
+
+# Use only the ArcFace recognition model on aligned YOLO boxes instead of FaceAnalysis.get
+# (which reruns detection, landmarks and gender/age on every crop)
+RECOGNITION_ONLY = True
+ARCFACE_SIZE = 112
+EMBEDDING_DIM = 512
+REC_BATCH_SIZE = 64                   # max faces per onnxruntime call
+LANDMARK_BATCH_SIZE = 64              # max faces per landmarker call
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))   # onnxruntime threads per session; 0 = library default
+# Align detector boxes without keypoints with 5 points from buffalo_l's 106-point landmarker,
+# the same kind of landmarks enrollment (FaceAnalysis.get) aligns with; false = box prior only
+QUERY_LANDMARKS = os.getenv("QUERY_LANDMARKS", "true").lower() == "true"
+LANDMARKER = "landmark_2d_106"
+
+# Last-resort 5-point landmarks as fractions of a YOLO face box (x, y), used when neither the
+# detector nor the landmarker gives keypoints. Derived from the ArcFace 112x112 template assuming the
+# box spans roughly x 16..96, y 20..112 of it.
+BOX_PRIOR_LANDMARKS = np.array([
+    [0.279, 0.345],   # left eye
+    [0.719, 0.342],   # right eye
+    [0.500, 0.562],   # nose tip
+    [0.319, 0.787],   # left mouth corner
+    [0.684, 0.785],   # right mouth corner
+], dtype=np.float32)
 
 
 # -------------------------------------------
@@ -10,35 +38,250 @@ from insightface.app import FaceAnalysis
 def load_model():
     app = FaceAnalysis(name="buffalo_l")     # ArcFace 100k model
     app.prepare(ctx_id=0, det_size=(640, 640))
+    if INTRA_OP_THREADS > 0:
+        limit_session_threads(app, INTRA_OP_THREADS)
     return app
 
 
+def limit_session_threads(app, threads):
+    """
+    Recreate every InsightFace onnxruntime session with a fixed intra-op thread count
+    (FaceAnalysis does not take session options). With threads=1 onnxruntime starts no
+    pool threads, so the sessions can be created before a pre-fork server forks.
+    """
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = threads
+    opts.inter_op_num_threads = 1
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    for model in app.models.values():
+        providers = model.session.get_providers()
+        model.session = ort.InferenceSession(model.model_file, sess_options=opts, providers=providers)
+
+
+class ModelManager:
+    """
+    Process-wide holder for the InsightFace model.
+    The model is loaded and prepared once (double-checked under a lock) and then shared
+    by all request threads; onnxruntime sessions are safe to run concurrently.
+    """
+
+    def __init__(self, loader=load_model):
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    start = time.perf_counter()
+                    self._model = self._loader()
+                    print(f"InsightFace model loaded in {time.perf_counter() - start:.2f}s")
+        return self._model
+
+    def reset(self):
+        """Forget the loaded model (and any lock state inherited through fork)."""
+        self._model = None
+        self._lock = threading.Lock()
+
+    def warmup(self):
+        """
+        Load the model and run every session the request paths use once, so the first request
+        doesn't pay for it: detection (FaceAnalysis.get, enrollment), recognition on an aligned
+        crop and the landmarker on a dummy box (the recognition-only query path).
+        A black image has no face, so FaceAnalysis.get alone never reaches the other two.
+        """
+        model = self.get()
+        start = time.perf_counter()
+        blank = np.zeros((ARCFACE_SIZE, ARCFACE_SIZE, 3), dtype=np.uint8)
+        model.get(blank)
+        model.models["recognition"].get_feat([blank])
+        estimate_landmarks_batch(model, [blank], [[16, 16, 96, 96]])
+        print(f"InsightFace model warmed up in {time.perf_counter() - start:.2f}s")
+        return model
+
+
+model_manager = ModelManager()
+
+
+def get_model():
+    return model_manager.get()
+
+
 # ---------------------------------------------------
 # Generate embedding for one image
+# (BGR numpy array, or a path for images downloaded to disk)
 # ---------------------------------------------------
-def generate_embedding(model, image_path):
-    img = cv2.imread(image_path)
-    faces = model.get(img)
+def generate_embedding(model, image):
+    if isinstance(image, str):
+        label = image
+        image = cv2.imread(image)
+    else:
+        label = f"in-memory crop {image.shape[1]}x{image.shape[0]}"
+
+    if image is None or image.size == 0:
+        print(f"Could not read image {label}")
+        return None
+
+    faces = model.get(image)
 
     if len(faces) == 0:
-        print(f"No face found in {image_path}")
+        print(f"No face found in {label}")
         return None
 
     return faces[0].embedding.tolist()
 
 
+# ---------------------------------------------------
+# Recognition-only path for faces already found by YOLO
+# ---------------------------------------------------
+def five_points_from_106(lmk):
+    """
+    ArcFace's 5 points (eyes, nose tip, mouth corners; image-left first) from the 2d106 markup:
+    33-42 and 87-96 outline the eyes, 52-71 the mouth, 86 is the nose tip.
+    Eyes and mouth corners are ordered by x, so mirrored markups map the same way.
+    """
+    eyes = sorted([lmk[33:43].mean(axis=0), lmk[87:97].mean(axis=0)], key=lambda p: p[0])
+    mouth = lmk[52:72]
+    return np.array([
+        eyes[0],
+        eyes[1],
+        lmk[86],
+        mouth[mouth[:, 0].argmin()],
+        mouth[mouth[:, 0].argmax()],
+    ], dtype=np.float32)
+
+
+def estimate_landmarks_batch(model, frames, boxes):
+    """
+    5 alignment points per face box from the 106-point landmarker, with one landmarker call per
+    LANDMARK_BATCH_SIZE faces (a list of None without a landmarker). Crops and decodes exactly like insightface's Landmark.get (box-centred square, 1.5x the long
+    side); models exported with a fixed batch of 1 are run face by face.
+    """
+    landmarker = model.models.get(LANDMARKER)
+    if landmarker is None:
+        return [None] * len(boxes)
+    if not boxes:
+        return []
+    size = landmarker.input_size[0]
+    crops = []
+    inverse = []
+    for frame, (x1, y1, x2, y2) in zip(frames, boxes):
+        scale = size / (max(x2 - x1, y2 - y1) * 1.5)
+        crop, M = face_align.transform(frame, ((x1 + x2) / 2, (y1 + y2) / 2), size, scale, 0)
+        crops.append(crop)
+        inverse.append(cv2.invertAffineTransform(M))
+
+    batch_size = 1 if landmarker.input_shape[0] == 1 else LANDMARK_BATCH_SIZE
+    mean = (landmarker.input_mean,) * 3
+    preds = []
+    for i in range(0, len(crops), batch_size):
+        blob = cv2.dnn.blobFromImages(crops[i:i + batch_size], 1.0 / landmarker.input_std, (size, size), mean, swapRB=True)
+        preds.append(landmarker.session.run(landmarker.output_names, {landmarker.input_name: blob})[0])
+    preds = np.concatenate(preds).reshape(len(crops), -1, 2)[:, -landmarker.lmk_num:]
+    preds = (preds + 1) * (size // 2)
+
+    points = []
+    for pred, IM in zip(preds, inverse):
+        lmk = pred @ IM[:, :2].T + IM[:, 2]
+        points.append(five_points_from_106(lmk.astype(np.float32)))
+    return points
+
+
+def faces_landmarks(model, faces):
+    """
+    Alignment points per face: detector keypoints, else landmarker points (QUERY_LANDMARKS, or
+    always for faces marked "estimate_landmarks" whose boxes don't fit the YOLO box prior) from
+    one batched landmarker run, else None (box prior).
+    """
+    points = [face.get("kpts") for face in faces]
+    todo = [i for i, face in enumerate(faces)
+            if points[i] is None and face.get("estimate_landmarks", QUERY_LANDMARKS)]
+    estimated = estimate_landmarks_batch(model, [faces[i]["frame"] for i in todo], [faces[i]["box"] for i in todo])
+    for i, lmk in zip(todo, estimated):
+        points[i] = lmk
+    return points
+
+
+def align_face(frame, box, kpts=None):
+    """
+    Warp a detected face to the 112x112 ArcFace template.
+    Uses the given 5 keypoints when available, otherwise landmarks estimated from the box.
+    """
+    if kpts is None:
+        x1, y1, x2, y2 = box
+        kpts = BOX_PRIOR_LANDMARKS * np.array([x2 - x1 + 1, y2 - y1 + 1], dtype=np.float32) + np.array([x1, y1], dtype=np.float32)
+    return face_align.norm_crop(frame, np.asarray(kpts, dtype=np.float32), image_size=ARCFACE_SIZE)
+
+
+def embed_aligned_batch(model, aligned):
+    """
+    Embed a list of aligned 112x112 BGR crops. All crops are stacked into one NCHW tensor
+    (in chunks of REC_BATCH_SIZE) so onnxruntime is called once per chunk instead of once per face.
+    Returns an (N, 512) float32 array.
+    """
+    rec = model.models["recognition"]
+    if not aligned:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    chunks = [
+        rec.get_feat(aligned[i:i + REC_BATCH_SIZE])
+        for i in range(0, len(aligned), REC_BATCH_SIZE)
+    ]
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+
+def align_faces(model, faces):
+    """Aligned 112x112 crops for detect_faces() results, in the same order as faces."""
+    return [align_face(f["frame"], f["box"], kpts) for f, kpts in zip(faces, faces_landmarks(model, faces))]
+
+
+def embed_faces_batch(model, faces):
+    """
+    Align and embed detect_faces() results (possibly from several frames) in one batch: one
+    landmarker call for the faces that need landmarks and one recognition call, per chunk of
+    LANDMARK_BATCH_SIZE / REC_BATCH_SIZE faces. Returns an (N, 512) float32 array in the same
+    order as faces.
+    """
+    return embed_aligned_batch(model, align_faces(model, faces))
+
+
 # ---------------------------------------------------
 # BULK embedding generation
 # ---------------------------------------------------
-def generate_bulk_embeddings(image_paths):
+def generate_bulk_embeddings(image_paths, embed_fn=embed_faces_batch):
+    """
+    image_paths: list of dicts with either "image" (numpy crop from detect_faces)
+    or "image_path" (file on disk), plus "file_id".
+    detect_faces results (which carry "frame" and "box") go through the batched
+    recognition-only path, embed_fn(model, faces) (e.g. batching.embed_faces).
+    Returns {file_id: embedding}; items without a file_id are keyed by their index.
+    """
 
-    model = load_model()
-    embeddings = {}
+    model = get_model()
+    results = {}
 
-    for path in image_paths:
-        print(f"Processing: {path.get('image_path')}")
-        emb = generate_embedding(model, path.get("image_path"))
+    detected = []
+    for idx, item in enumerate(image_paths):
+        if RECOGNITION_ONLY and item.get("frame") is not None and item.get("box") is not None:
+            detected.append(idx)
+            continue
+        image = item.get("image")
+        if image is None:
+            image = item.get("image_path")
+            print(f"Processing: {image}")
+        emb = generate_embedding(model, image)
         if emb is not None:
-            embeddings[path.get("file_id")] = emb
+            results[idx] = emb
+
+    if detected:
+        batch = embed_fn(model, [image_paths[idx] for idx in detected])
+        for idx, emb in zip(detected, batch):
+            results[idx] = emb.tolist()
+
+    # keep input order in the returned dict
+    embeddings = {}
+    for idx in sorted(results):
+        key = image_paths[idx].get("file_id")
+        embeddings[key if key is not None else idx] = results[idx]
 
     return embeddings
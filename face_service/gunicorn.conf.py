@@ -0,0 +1,70 @@
+"""
+Production server for face_service:  gunicorn -c gunicorn.conf.py service:app
+
+The app (and with it the YOLO weights and InsightFace sessions) is loaded once in the master
+and workers are forked from it, so model memory is shared copy-on-write instead of copied per
+worker. Each worker then limits its own intra-op threads (runtime.after_fork), so
+FACE_WORKERS x INTRA_OP_THREADS can be sized to the host's cores.
+
+Environment:
+    FACE_WORKERS       worker processes (default: cores // INTRA_OP_THREADS)
+    FACE_THREADS       request threads per worker (default 4)
+    INTRA_OP_THREADS   torch / OpenCV / onnxruntime threads per worker (default 1, or all
+                       cores when only one worker runs; above 1, InsightFace sessions are
+                       built per worker after fork)
+    FACE_TIMEOUT       worker timeout in seconds (default 120)
+
+Per-worker state: async job queues, micro-batches (batching.py) and admission control
+(admission.py) live in each worker, so batches only group requests that reached the same
+worker and ADMISSION_CONCURRENCY is per worker (service capacity = workers x that). Job
+records must be shared for /jobs/<id> to work from any worker: with ASYNC_PROCESSING=true and
+JOB_STORE=memory (no DATABASE_URL) only one worker is started, unless FACE_WORKERS is set.
+"""
+
+import gc
+import multiprocessing
+import os
+
+_cores = multiprocessing.cpu_count()
+# same default as jobs.JOB_STORE; in-memory job records are only visible to the worker that ran the job
+_job_store = os.getenv("JOB_STORE", "postgres" if os.getenv("DATABASE_URL") else "memory").lower()
+_async_default = os.getenv("ASYNC_PROCESSING", "false").lower() == "true"
+# async by default with per-worker job records: one worker (using every core) unless FACE_WORKERS says otherwise
+_single_worker = _job_store == "memory" and _async_default and "FACE_WORKERS" not in os.environ
+
+os.environ.setdefault("INTRA_OP_THREADS", str(_cores) if _single_worker else "1")
+# the master must not start OpenMP / MKL pools before forking; workers raise the limit in post_fork
+os.environ["OMP_NUM_THREADS"] = "1"
+os.environ["MKL_NUM_THREADS"] = "1"
+os.environ["FACE_SERVICE_PREFORK"] = "true"
+
+_intra_op_threads = max(1, int(os.environ["INTRA_OP_THREADS"]))
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+if _single_worker:
+    print("[WARNING] ASYNC_PROCESSING=true with JOB_STORE=memory: running 1 worker so /jobs/<id> finds every job")
+    workers = 1
+else:
+    workers = int(os.getenv("FACE_WORKERS", max(1, _cores // _intra_op_threads)))
+    if _job_store == "memory" and workers > 1:
+        print(f"[WARNING] JOB_STORE=memory with {workers} workers: /jobs/<id> only finds jobs of the worker it reaches")
+threads = int(os.getenv("FACE_THREADS", "4"))
+worker_class = "gthread"
+preload_app = True
+timeout = int(os.getenv("FACE_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+accesslog = "-"
+
+
+def when_ready(server):
+    # keep the preloaded objects out of the GC's generations so collections in the
+    # workers don't write to (and un-share) their pages
+    gc.freeze()
+    server.log.info(f"face_service preloaded: {workers} workers x {threads} threads, "
+                    f"{_intra_op_threads} intra-op threads each")
+
+
+def post_fork(server, worker):
+    import runtime
+    runtime.after_fork()
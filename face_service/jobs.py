@@ -0,0 +1,291 @@
+"""
+Background job queue for asynchronous frame processing (process_with_attendance?async=true).
+
+Requests are validated and decoded in the Flask handler, then enqueued on a bounded queue and
+answered with 202 + a job id; a fixed pool of worker threads runs the pipeline. Finished jobs are
+kept for JOB_RESULT_TTL seconds so clients can poll /jobs/<id>.
+
+The queue and its threads belong to the process that accepted the job, but job records live in
+a JobStore. With several gunicorn workers (or replicas) the store must be shared, otherwise a
+poll that lands on another worker finds nothing: JOB_STORE=postgres keeps them in the face_jobs
+table (db/migrations/004_face_jobs.sql) and is the default when DATABASE_URL is set.
+JOB_STORE=memory keeps them in this process only; gunicorn.conf.py then runs one worker when
+ASYNC_PROCESSING=true (and FACE_WORKERS is unset).
+
+A job whose worker exits (restart, redeploy) never finishes: unfinished jobs older than
+JOB_MAX_AGE are failed on the next submit, and a starting worker fails the unfinished jobs of
+exited workers on its host (recover(), called from runtime.after_fork).
+"""
+
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from pgvector_index import DATABASE_URL, get_pool
+
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "32"))        # max frames waiting for a worker
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", "3600"))      # seconds finished jobs stay queryable
+JOB_MAX_AGE = int(os.getenv("JOB_MAX_AGE", "900"))              # seconds before an unfinished job is failed as abandoned
+JOB_STORE = os.getenv("JOB_STORE", "postgres" if DATABASE_URL else "memory").lower()   # "postgres" or "memory"
+
+
+ABANDONED_ERROR = "Job abandoned: its worker exited or it ran past JOB_MAX_AGE"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+def worker_name(pid=None):
+    """Owner of the jobs queued in this process: "<hostname>:<pid>"."""
+    return f"{socket.gethostname()}:{os.getpid() if pid is None else pid}"
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class MemoryJobStore:
+    """Job records in this process only (single worker)."""
+
+    shared = False
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job["id"]] = job
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                job.update(fields)
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def running(self, stale_cutoff):
+        with self._lock:
+            return sum(1 for job in self._jobs.values()
+                       if job["status"] == "running" and job["submitted_at"] >= stale_cutoff)
+
+    def expire(self, cutoff, stale_cutoff):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job["finished_at"] is not None and job["finished_at"] < cutoff]
+            for job_id in expired:
+                del self._jobs[job_id]
+            for job in self._jobs.values():
+                if job["finished_at"] is None and job["submitted_at"] < stale_cutoff:
+                    job.update(status="failed", finished_at=now, status_code=500, error=ABANDONED_ERROR)
+
+    def fail_orphans(self):
+        """Jobs of exited workers die with their process; nothing to do."""
+        return 0
+
+
+class PostgresJobStore:
+    """Job records in the face_jobs table, visible to every worker and replica."""
+
+    shared = True
+    COLUMNS = ("id", "status", "submitted_at", "started_at", "finished_at", "result", "status_code", "error")
+    FAIL_UNFINISHED = ("UPDATE face_jobs SET status = 'failed', finished_at = %(now)s, status_code = 500, "
+                       "error = %(error)s WHERE finished_at IS NULL")
+
+    def _execute(self, sql, params=(), fetch=None):
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql, params)
+                if fetch == "one":
+                    return cur.fetchone()
+                if fetch == "all":
+                    return cur.fetchall()
+                return cur.rowcount
+        finally:
+            pool.putconn(conn)
+
+    def create(self, job):
+        self._execute(
+            "INSERT INTO face_jobs (id, status, submitted_at, worker) VALUES (%s, %s, %s, %s)",
+            (job["id"], job["status"], job["submitted_at"], worker_name())
+        )
+
+    def update(self, job_id, **fields):
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{name} = %({name})s" for name in fields)
+        self._execute(f"UPDATE face_jobs SET {assignments} WHERE id = %(id)s", dict(fields, id=job_id))
+
+    def delete(self, job_id):
+        self._execute("DELETE FROM face_jobs WHERE id = %s", (job_id,))
+
+    def get(self, job_id):
+        row = self._execute(f"SELECT {', '.join(self.COLUMNS)} FROM face_jobs WHERE id = %s", (job_id,), fetch="one")
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def running(self, stale_cutoff):
+        return self._execute("SELECT count(*) FROM face_jobs WHERE status = 'running' AND submitted_at >= %s",
+                             (stale_cutoff,), fetch="one")[0]
+
+    def expire(self, cutoff, stale_cutoff):
+        self._execute("DELETE FROM face_jobs WHERE finished_at < %s", (cutoff,))
+        self._execute(self.FAIL_UNFINISHED + " AND submitted_at < %(stale)s",
+                      {"now": time.time(), "error": ABANDONED_ERROR, "stale": stale_cutoff})
+
+    def fail_orphans(self):
+        """
+        Fail the unfinished jobs of workers on this host that are no longer running (a worker
+        restarted by gunicorn, or this process reusing a dead worker's pid). Returns the count.
+        """
+        host = socket.gethostname()
+        owners = self._execute(
+            "SELECT DISTINCT worker FROM face_jobs WHERE finished_at IS NULL AND worker LIKE %s",
+            (host + ":%",), fetch="all"
+        )
+        dead = []
+        for (owner,) in owners:
+            pid = owner.rpartition(":")[2]
+            if not pid.isdigit() or int(pid) == os.getpid() or not pid_alive(int(pid)):
+                dead.append(owner)
+        if not dead:
+            return 0
+        return self._execute(self.FAIL_UNFINISHED + " AND worker = ANY(%(dead)s)",
+                             {"now": time.time(), "error": ABANDONED_ERROR, "dead": dead})
+
+
+def make_store(kind=JOB_STORE):
+    if kind == "postgres":
+        return PostgresJobStore()
+    if kind == "memory":
+        return MemoryJobStore()
+    raise ValueError(f"Unknown JOB_STORE {kind!r} (expected postgres or memory)")
+
+
+class JobQueue:
+
+    def __init__(self, workers=JOB_WORKERS, maxsize=JOB_QUEUE_SIZE, result_ttl=JOB_RESULT_TTL,
+                 max_age=JOB_MAX_AGE, store=None):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.result_ttl = result_ttl
+        self.max_age = max_age
+        self.store = store if store is not None else make_store()
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self.stats = {"submitted": 0, "rejected": 0, "done": 0, "failed": 0}
+
+    def recover(self):
+        """Run at worker startup: fail jobs left unfinished by workers that exited."""
+        try:
+            failed = self.store.fail_orphans()
+        except Exception as e:
+            print(f"Error failing orphaned jobs: {e}")
+            return
+        if failed:
+            print(f"[INFO] Failed {failed} jobs orphaned by exited workers")
+
+    def start(self):
+        if not self._threads:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Enqueue fn(*args, **kwargs) and return the job id.
+        fn returns (result dict, HTTP status code), the same contract as the synchronous handler.
+        Raises QueueFullError when JOB_QUEUE_SIZE jobs are already waiting in this process.
+        """
+        self.start()
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "status_code": None,
+            "error": None,
+        }
+        now = time.time()
+        self.store.expire(now - self.result_ttl, now - self.max_age)
+        # recorded before it is queued, so a fast worker never updates a missing job
+        self.store.create(job)
+        try:
+            self._queue.put_nowait((job_id, fn, args, kwargs))
+        except queue.Full:
+            self.store.delete(job_id)
+            with self._lock:
+                self.stats["rejected"] += 1
+            raise QueueFullError(f"Job queue is full ({self.maxsize} waiting)")
+        with self._lock:
+            self.stats["submitted"] += 1
+        return job_id
+
+    def get(self, job_id):
+        """Copy of the job record, or None for unknown / expired ids."""
+        return self.store.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def status(self):
+        """Counters and queue depth of this process; "running" counts every worker when the store is shared (jobs older than JOB_MAX_AGE excluded)."""
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(stats, depth=self.depth(), capacity=self.maxsize, workers=self.workers,
+                    running=self.store.running(time.time() - self.max_age), store="postgres" if self.store.shared else "memory",
+                    pid=os.getpid())
+
+    def _run(self):
+        while True:
+            job_id, fn, args, kwargs = self._queue.get()
+            self._update(job_id, status="running", started_at=time.time())
+            try:
+                result, status_code = fn(*args, **kwargs)
+                update = {"status": "done" if status_code < 400 else "failed",
+                          "result": result, "status_code": status_code}
+            except Exception as e:
+                traceback.print_exc()
+                update = {"status": "failed", "error": str(e), "status_code": 500}
+            self._update(job_id, finished_at=time.time(), **update)
+            with self._lock:
+                self.stats["done" if update["status"] == "done" else "failed"] += 1
+            self._queue.task_done()
+
+    def _update(self, job_id, **fields):
+        # a job store outage must not stop the worker thread (or skip the job)
+        try:
+            self.store.update(job_id, **fields)
+        except Exception as e:
+            print(f"Error updating job {job_id}: {e}")
+
+
+job_queue = JobQueue()
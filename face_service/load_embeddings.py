@@ -1,90 +1,381 @@
 import os
-import requests
 import numpy as np
 import threading
 import time
-from collections import defaultdict
+import runtime
+from embeddings_comparator import Gallery, ClassPartitionedGallery, l2_normalize, reserve_rows
+from ann_index import ANN_BACKEND, build_global_index, update_global_index
+from pgvector_index import PgVectorClassGalleries
+from utilities.embedding_codec import EMBEDDINGS_MEDIA_TYPE, unpack_embeddings, to_columns_payload
+from web_client import web_client
 
-embeddings = []
+# Search the whole institution when a class has no reference embeddings
+GALLERY_GLOBAL_FALLBACK = os.getenv("GALLERY_GLOBAL_FALLBACK", "false").lower() == "true"
+DELTA_PAGE_SIZE = int(os.getenv("EMBEDDINGS_DELTA_PAGE_SIZE", "1000"))
+REFRESH_INTERVAL = int(os.getenv("EMBEDDINGS_REFRESH_INTERVAL", "300"))          # delta sync every 5 minutes
+FULL_RELOAD_INTERVAL = int(os.getenv("EMBEDDINGS_FULL_RELOAD_INTERVAL", "86400"))  # full reload daily (class changes)
+EMBEDDINGS_TRANSPORT = os.getenv("EMBEDDINGS_TRANSPORT", "binary").lower()           # "binary" or "json" full loads
+EMBEDDINGS_DTYPE = os.getenv("EMBEDDINGS_DTYPE", "float32")                          # binary wire dtype: float32 / float16
+EMBEDDINGS_FETCH_TIMEOUT = float(os.getenv("EMBEDDINGS_FETCH_TIMEOUT", "30"))        # seconds, full export can be large
 
-def load_embeddings():
 
+class GallerySnapshot:
+    """
+    Everything a request needs to match faces, built completely before it is published.
+    Never mutated after construction, so readers can hold on to it for the whole request.
 
-# ... inside load_embeddings() function ...
+    Rows (embedding id, student id, class id, L2-normalized vector) are kept in parallel arrays.
+    A delta builds the next snapshot with extended() in O(changed rows): new rows are written
+    past this snapshot's length into spare capacity of the same arrays (doubling when full),
+    deleted rows are masked out, only the touched class shards are rebuilt and an IVF index is
+    updated instead of retrained. This snapshot only ever reads its first n rows, so none of
+    that is visible to requests still using it.
+    """
 
-    global embeddings
-    
-    try:
-        web_service_url = os.getenv("WEB_SERVICE_URL")
-        api_key = os.getenv("PUBLIC_API_KEY", "default-insecure-key")
-        
-        if not web_service_url:
-            print("Warning: WEB_SERVICE_URL not set, skipping embeddings load")
-            embeddings = []
-            return
-        
-        headers = {
-            "X-API-Key": api_key
-        }
-        
-        resp = requests.get(
-            f"{web_service_url}/public/api/get-embeddings",
-            headers=headers,
-            timeout=10
-        )
-        resp.raise_for_status()
-        
-        data = resp.json()
-        if data and "embeddings" in data:
-            embeddings_list = data["embeddings"]
-            
-            # Use a dictionary to group multiple embeddings per student
-            grouped_embeddings = defaultdict(list)
-            
-            for item in embeddings_list:
-                s_id = item["student_id"]
-                vector = np.array(item["embedding"], dtype=np.float32)
-                grouped_embeddings[s_id].append(vector)
-            
-            # Set the global variable to this dictionary
-            embeddings = dict(grouped_embeddings) 
-            print(f"Successfully loaded embeddings for {len(embeddings)} unique students")
-            """Load embeddings from web service public API with error handling"""
+    def __init__(self, embedding_ids, student_ids, class_ids, vectors, cursor, synced_at=None):
+        self.cursor = cursor
+        self.synced_at = synced_at  # when the data was read from the web service (unix time)
+        self.n = len(embedding_ids)
+        self.embedding_ids = np.asarray(embedding_ids, dtype=np.int64)
+        self.student_ids = np.asarray(student_ids, dtype=np.int64)
+        self.class_ids = np.asarray(class_ids, dtype=object)
+        self.vectors = l2_normalize(vectors)
+        self.alive = np.ones(self.n, dtype=bool)
+        self.row_of = dict(zip(self.embedding_ids.tolist(), range(self.n)))
+
+        # rows per class, grouped with one sort
+        known = np.flatnonzero(np.not_equal(self.class_ids, None))
+        classes, inverse = np.unique(self.class_ids[known].astype(np.int64), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(classes) + 1))
+        self.class_rows = {class_id: known[order[bounds[i]:bounds[i + 1]]] for i, class_id in enumerate(classes.tolist())}
+
+        self.gallery = self._view()
+        if ANN_BACKEND == "pgvector":
+            # searches run in Postgres; the snapshot stays empty
+            self.class_galleries = PgVectorClassGalleries(GALLERY_GLOBAL_FALLBACK)
+            self.global_index = self.class_galleries.global_gallery
         else:
-            print("No embeddings found from web service")
-            embeddings = []
-    
-    except requests.exceptions.Timeout:
-        print("Timeout while loading embeddings from web service")
-        embeddings = []
-    except requests.exceptions.ConnectionError:
-        print("Failed to connect to web service for embeddings")
-        embeddings = []
-    except requests.exceptions.HTTPError as e:
-        print(f"HTTP error while loading embeddings: {e}")
-        if hasattr(e.response, 'text'):
-            print(f"Response: {e.response.text}")
-        embeddings = []
-    except ValueError as e:
-        print(f"Invalid JSON response from web service: {e}")
-        embeddings = []
+            self.global_index = build_global_index(self.gallery)
+            shards = {class_id: self.gallery.subset(rows) for class_id, rows in self.class_rows.items()}
+            self.class_galleries = ClassPartitionedGallery(self.gallery, GALLERY_GLOBAL_FALLBACK,
+                                                           self.global_index, shards)
+
+    @classmethod
+    def empty(cls):
+        return cls([], [], [], np.zeros((0, 0), dtype=np.float32), None)
+
+    def _view(self):
+        """Gallery over this snapshot's first n rows (views, no copies)."""
+        alive = self.alive[:self.n]
+        return Gallery.from_normalized(self.vectors[:self.n], self.student_ids[:self.n], self.class_ids[:self.n],
+                                       None if alive.all() else alive)
+
+    def live_rows(self):
+        return np.flatnonzero(self.alive[:self.n])
+
+    def num_students(self):
+        return len(np.unique(self.student_ids[self.live_rows()]))
+
+    def extended(self, added, deleted, cursor, synced_at):
+        """
+        New snapshot with added {embedding_id: (student_id, class_id, vector)} appended and
+        deleted embedding ids removed. Ids already present are not added again (rows written
+        right after a full export's cursor can be sent again).
+        """
+        added = {eid: row for eid, row in added.items() if eid not in self.row_of}
+        removed_rows = [self.row_of[eid] for eid in deleted if eid in self.row_of]
+        live = len(self.gallery) + len(added) - len(removed_rows)
+        if not self.n or live < (self.n + len(added)) // 2:
+            # nothing to extend yet, or mostly deleted rows: start over from the live rows
+            return self._rebuilt(added, removed_rows, cursor, synced_at)
+
+        snapshot = object.__new__(GallerySnapshot)
+        snapshot.__dict__.update(self.__dict__)
+        snapshot.cursor = cursor
+        snapshot.synced_at = synced_at
+
+        start, end = self.n, self.n + len(added)
+        snapshot.n = end
+        if added:
+            snapshot.embedding_ids = reserve_rows(self.embedding_ids, end)
+            snapshot.student_ids = reserve_rows(self.student_ids, end)
+            snapshot.class_ids = reserve_rows(self.class_ids, end)
+            snapshot.vectors = reserve_rows(self.vectors, end)
+            snapshot.alive = reserve_rows(self.alive, end)
+            snapshot.embedding_ids[start:end] = list(added)
+            snapshot.student_ids[start:end] = [student_id for student_id, _, _ in added.values()]
+            snapshot.class_ids[start:end] = [class_id for _, class_id, _ in added.values()]
+            snapshot.vectors[start:end] = l2_normalize(np.stack([vector for _, _, vector in added.values()]))
+            snapshot.alive[start:end] = True
+        if removed_rows:
+            # copy first: earlier snapshots share this mask
+            snapshot.alive = snapshot.alive.copy()
+            snapshot.alive[removed_rows] = False
+
+        snapshot.row_of = dict(self.row_of)
+        for eid in deleted:
+            snapshot.row_of.pop(eid, None)
+        snapshot.row_of.update(zip(added, range(start, end)))
+
+        new_rows = np.arange(start, end)
+        snapshot.gallery = snapshot._view()
+        if ANN_BACKEND == "pgvector":
+            return snapshot
+        snapshot.global_index = update_global_index(self.global_index, snapshot.gallery, new_rows, removed_rows)
+
+        snapshot.class_rows = dict(self.class_rows)
+        touched = set(snapshot.class_ids[np.concatenate([new_rows, removed_rows]).astype(np.int64)].tolist())
+        touched.discard(None)
+        shards = {}
+        for class_id in touched:
+            rows = np.concatenate([self.class_rows.get(class_id, np.zeros(0, dtype=np.int64)),
+                                   new_rows[snapshot.class_ids[start:end] == class_id]]).astype(np.int64)
+            rows = rows[snapshot.alive[rows]]
+            if len(rows):
+                snapshot.class_rows[class_id] = rows
+                shards[class_id] = snapshot.gallery.subset(rows)
+            else:
+                snapshot.class_rows.pop(class_id, None)
+                shards[class_id] = None
+        snapshot.class_galleries = self.class_galleries.updated(shards, snapshot.global_index)
+        return snapshot
+
+    def _rebuilt(self, added, removed_rows, cursor, synced_at):
+        """Full (compacted) snapshot from this one's live rows plus added."""
+        alive = self.alive[:self.n].copy()
+        alive[removed_rows] = False
+        rows = np.flatnonzero(alive)
+        embedding_ids = self.embedding_ids[rows].tolist() + list(added)
+        student_ids = self.student_ids[rows].tolist() + [student_id for student_id, _, _ in added.values()]
+        class_ids = self.class_ids[rows].tolist() + [class_id for _, class_id, _ in added.values()]
+        vectors = [self.vectors[rows]] + [np.asarray(vector, dtype=np.float32)[None] for _, _, vector in added.values()]
+        dim = max((v.shape[1] for v in vectors if v.size), default=0)
+        vectors = np.concatenate([v.reshape(len(v), dim) for v in vectors]) if embedding_ids else np.zeros((0, dim), np.float32)
+        return GallerySnapshot(embedding_ids, student_ids, class_ids, vectors, cursor, synced_at)
+
+
+_snapshot = GallerySnapshot.empty()
+
+
+def current():
+    """The published gallery snapshot (a single reference read, safe from any thread)."""
+    return _snapshot
+
+
+def _fetch(path, params=None, binary=False):
+    """
+    GET a web service public API path over the shared pooled client (retried on transient errors).
+    Raises on any error. With binary=True, asks for the binary embeddings format and decodes it
+    (older web services that only speak JSON are still understood).
+    """
+    headers = {}
+    if binary:
+        headers["Accept"] = f"{EMBEDDINGS_MEDIA_TYPE}, application/json;q=0.5"
+        params = dict(params or {}, dtype=EMBEDDINGS_DTYPE)
+
+    resp = web_client.get(path, headers=headers, params=params, timeout=EMBEDDINGS_FETCH_TIMEOUT)
+    resp.raise_for_status()
+    if resp.headers.get("Content-Type", "").startswith(EMBEDDINGS_MEDIA_TYPE):
+        return to_columns_payload(*unpack_embeddings(resp.content))
+    return resp.json()
+
+
+def _parse_row(item):
+    vector = np.asarray(item["embedding"], dtype=np.float32)
+    return item["student_id"], item.get("class_id"), vector
+
+
+def _snapshot_from_items(items, cursor, synced_at):
+    """Full snapshot from JSON rows ({embedding_id, student_id, class_id, embedding})."""
+    if not items:
+        return GallerySnapshot([], [], [], np.zeros((0, 0), dtype=np.float32), cursor, synced_at)
+    return GallerySnapshot(
+        [item["embedding_id"] for item in items],
+        [item["student_id"] for item in items],
+        [item.get("class_id") for item in items],
+        np.stack([np.asarray(item["embedding"], dtype=np.float32) for item in items]),
+        cursor,
+        synced_at
+    )
+
+
+def build_full_snapshot():
+    """Full load of every reference embedding from the web service public API."""
+    synced_at = time.time()
+    data = _fetch("/public/api/get-embeddings", binary=EMBEDDINGS_TRANSPORT == "binary")
+    if data and "columns" in data:
+        # binary export: arrays straight from the decoded buffer (the trailer already checked the count)
+        return GallerySnapshot(*data["columns"], data.get("cursor"), synced_at)
+    if not data or "embeddings" not in data:
+        raise ValueError("No embeddings found from web service")
+    if data.get("count", len(data["embeddings"])) != len(data["embeddings"]):
+        raise ValueError(f"Incomplete embeddings export: {len(data['embeddings'])} of {data['count']} rows")
+
+    return _snapshot_from_items(data["embeddings"], data.get("cursor"), synced_at)
+
+
+def build_delta_snapshot(base):
+    """
+    Apply embeddings created/deleted since base.cursor (paging through
+    /public/api/get-embeddings-delta) on top of base (GallerySnapshot.extended).
+    Returns the new snapshot (base's gallery with an advanced cursor when nothing changed), or a
+    full snapshot when the web service has pruned tombstones newer than base.synced_at.
+    """
+    added = {}
+    deleted = set()
+    next_cursor = dict(base.cursor)
+    synced_at = time.time()
+    while True:
+        params = {f"after_{key}": value for key, value in next_cursor.items()}
+        params.update(limit=DELTA_PAGE_SIZE)
+        if base.synced_at is not None:
+            params["synced_at"] = base.synced_at
+        data = _fetch("/public/api/get-embeddings-delta", params=params)
+        if data.get("full_reload_required"):
+            print("Embeddings delta cursor is older than the tombstone retention, doing a full reload")
+            return build_full_snapshot()
+
+        for item in data.get("embeddings", []):
+            added[item["embedding_id"]] = _parse_row(item)
+        for embedding_id in data.get("deleted", []):
+            # created and deleted within this delta: never add it
+            if added.pop(embedding_id, None) is None:
+                deleted.add(embedding_id)
+
+        next_cursor = data["cursor"]
+        if not data.get("has_more"):
+            break
+
+    # rows written right after a full export's cursor can be sent again
+    if not any(eid not in base.row_of for eid in added) and not any(eid in base.row_of for eid in deleted):
+        return _with_cursor(base, next_cursor, synced_at)
+    return base.extended(added, deleted, next_cursor, synced_at)
+
+
+def _with_cursor(snapshot, cursor, synced_at):
+    """Same gallery, advanced cursor (avoids rebuilding indexes when a delta was empty)."""
+    clone = object.__new__(GallerySnapshot)
+    clone.__dict__.update(snapshot.__dict__)
+    clone.cursor = cursor
+    clone.synced_at = synced_at
+    return clone
+
+
+class GalleryRefresher:
+    """
+    Keeps the published gallery fresh on a fixed interval.
+    Each refresh builds a complete new snapshot off to the side and publishes it with a single
+    reference swap; if the refresh fails, the last good gallery stays in place.
+    """
+
+    def __init__(self, interval=REFRESH_INTERVAL, full_reload_interval=FULL_RELOAD_INTERVAL):
+        self.interval = interval
+        self.full_reload_interval = full_reload_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_full = 0.0
+        self.stats = {
+            "last_refresh_at": None,
+            "last_refresh_mode": None,
+            "last_refresh_seconds": None,
+            "last_refresh_ok": None,
+            "last_error": None,
+            "refresh_count": 0,
+            "failure_count": 0,
+        }
+
+    def refresh(self, full=False):
+        """Build and publish a new snapshot. Returns True on success."""
+        global _snapshot
+
+        with self._lock:
+            base = _snapshot
+            full = full or base.cursor is None or time.time() - self._last_full >= self.full_reload_interval
+            mode = "full" if full else "delta"
+            start = time.perf_counter()
+            try:
+                new_snapshot = build_full_snapshot() if full else build_delta_snapshot(base)
+            except Exception as e:
+                elapsed = time.perf_counter() - start
+                self.stats.update({
+                    "last_refresh_at": time.time(),
+                    "last_refresh_mode": mode,
+                    "last_refresh_seconds": round(elapsed, 3),
+                    "last_refresh_ok": False,
+                    "last_error": str(e),
+                    "failure_count": self.stats["failure_count"] + 1,
+                })
+                print(f"Embeddings {mode} refresh failed after {elapsed:.2f}s, keeping last good gallery "
+                      f"({len(base.gallery)} embeddings): {e}")
+                return False
+
+            # atomic publish: readers see either the old or the new snapshot, never a partial one
+            _snapshot = new_snapshot
+            if full:
+                self._last_full = time.time()
+            elapsed = time.perf_counter() - start
+            self.stats.update({
+                "last_refresh_at": time.time(),
+                "last_refresh_mode": mode,
+                "last_refresh_seconds": round(elapsed, 3),
+                "last_refresh_ok": True,
+                "last_error": None,
+                "refresh_count": self.stats["refresh_count"] + 1,
+            })
+            print(f"Embeddings {mode} refresh in {elapsed:.2f}s: {len(new_snapshot.gallery)} embeddings "
+                  f"for {new_snapshot.num_students()} unique students")
+            return True
+
+    def status(self):
+        snapshot = _snapshot
+        return dict(self.stats,
+                    backend=ANN_BACKEND,
+                    embeddings=len(snapshot.gallery),
+                    students=snapshot.num_students(),
+                    classes=len(snapshot.class_galleries.shards),
+                    cursor=snapshot.cursor,
+                    interval=self.interval)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Error in embeddings refresher: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="gallery-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def restart(self):
+        """
+        Start a fresh refresh thread in a forked worker: threads do not survive fork, and the
+        lock / event are replaced in case the parent held them at fork time.
+        """
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        if ANN_BACKEND != "pgvector":
+            self.start()
+
+
+refresher = GalleryRefresher()
+
+if ANN_BACKEND == "pgvector":
+    print("ANN_BACKEND=pgvector: matching runs in Postgres, no in-memory gallery to load")
+else:
+    # Initial load, then keep refreshing in the background
+    try:
+        refresher.refresh(full=True)
     except Exception as e:
-        print(f"Error loading embeddings: {e}")
-        embeddings = []
-
-# Schedule periodic reload
-t = threading.Timer(
-    3600, 
-    load_embeddings , 
-    args=() 
-)
-t.daemon = True  # Make thread daemon so it doesn't block shutdown
-t.start()
-
-# Initial load with timeout to not block startup
-try:
-    t.join(1)  # Wait max 1 second for initial load
-    load_embeddings()
-except Exception as e:
-    print(f"Error during initial embeddings load: {e}")
-    embeddings = []
\ No newline at end of file
+        print(f"Error during initial embeddings load: {e}")
+    # a preloading gunicorn master only serves the initial snapshot to its workers, which start
+    # their own refresh thread after fork (runtime.after_fork -> refresher.restart)
+    if not runtime.PREFORK:
+        refresher.start()
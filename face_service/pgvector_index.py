@@ -0,0 +1,150 @@
+"""
+Similarity search in Postgres with pgvector (ANN_BACKEND=pgvector).
+
+Reference vectors stay in students_embeddings.embedding_vec (see db/migrations/002_pgvector_embeddings.sql)
+behind an HNSW cosine index, so face-service replicas share one index instead of each holding the
+full gallery in RAM. PgVectorGallery exposes search_students(queries, k), which
+embeddings_comparator.match_students uses in place of the in-memory Gallery search.
+
+All query faces of a frame are matched in one round trip (unnest + LATERAL top-k per face).
+"""
+
+import os
+import threading
+
+try:
+    import psycopg2
+    from psycopg2.pool import ThreadedConnectionPool
+except ImportError:  # optional dependency, only needed for ANN_BACKEND=pgvector / JOB_STORE=postgres
+    psycopg2 = None
+
+DATABASE_URL = os.getenv("DATABASE_URL")
+PGVECTOR_POOL_SIZE = int(os.getenv("PGVECTOR_POOL_SIZE", "4"))
+PGVECTOR_EF_SEARCH = int(os.getenv("PGVECTOR_EF_SEARCH", "64"))                       # HNSW candidate list per query
+PGVECTOR_ITERATIVE_SCAN = os.getenv("PGVECTOR_ITERATIVE_SCAN", "relaxed_order")      # pgvector >= 0.8; "off" to disable
+
+TOP_K_SQL = """
+SELECT q.ord, m.student_id, m.score
+FROM unnest(%(queries)s::vector[]) WITH ORDINALITY AS q(vec, ord)
+CROSS JOIN LATERAL (
+    SELECT i.student_id, 1 - (e.embedding_vec <=> q.vec) AS score
+    FROM students_embeddings e
+    JOIN students_images i ON i.id = e.image_id
+    JOIN students s ON s.id = i.student_id
+    WHERE e.embedding_vec IS NOT NULL {class_filter}
+    ORDER BY e.embedding_vec <=> q.vec
+    LIMIT %(k)s
+) m
+ORDER BY q.ord, m.score DESC
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Shared connection pool, created on first use (also used by the Postgres job store in jobs.py)."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                if psycopg2 is None:
+                    raise RuntimeError("Postgres access needs psycopg2 (pip install psycopg2-binary)")
+                if not DATABASE_URL:
+                    raise RuntimeError("Postgres access needs DATABASE_URL")
+                _pool = ThreadedConnectionPool(1, PGVECTOR_POOL_SIZE, DATABASE_URL)
+    return _pool
+
+
+def vector_array_literal(queries):
+    """Postgres vector[] literal: {"[x,y,...]","[...]"}."""
+    return "{" + ",".join('"[' + ",".join(f"{x:.7g}" for x in q) + ']"' for q in queries) + "}"
+
+
+class PgVectorGallery:
+    """
+    Top-k cosine search against students_embeddings in Postgres, optionally limited to one class.
+    With fallback_to_global, a class that returns no matches at all is searched institution-wide.
+    """
+
+    def __init__(self, class_id=None, fallback_to_global=False):
+        self.class_id = class_id
+        self.fallback_to_global = fallback_to_global
+
+    def is_empty(self):
+        """
+        True if there is no searchable reference vector (in the class, or globally).
+        Checked on every request, so it stops at the first row instead of counting.
+        """
+        sql = ("SELECT EXISTS (SELECT 1 FROM students_embeddings e "
+               "JOIN students_images i ON i.id = e.image_id "
+               "JOIN students s ON s.id = i.student_id "
+               "WHERE e.embedding_vec IS NOT NULL{class_filter} LIMIT 1)")
+        params = ()
+        class_filter = ""
+        if self.class_id is not None and not self.fallback_to_global:
+            class_filter = " AND s.class_id = %s"
+            params = (self.class_id,)
+
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute(sql.format(class_filter=class_filter), params)
+                return not cur.fetchone()[0]
+        finally:
+            pool.putconn(conn)
+
+    def search_students(self, queries, k=5):
+        """(scores, student_ids) per query, each a list sorted by descending cosine similarity."""
+        queries = [[float(x) for x in q] for q in queries]
+        if not queries:
+            return [], []
+
+        results = self._query(queries, k, self.class_id)
+        if self.class_id is not None and self.fallback_to_global and not any(results[0]):
+            results = self._query(queries, k, None)
+        return results
+
+    def _query(self, queries, k, class_id):
+        params = {"queries": vector_array_literal(queries), "k": k}
+        class_filter = ""
+        if class_id is not None:
+            class_filter = "AND s.class_id = %(class_id)s"
+            params["class_id"] = class_id
+
+        pool = get_pool()
+        conn = pool.getconn()
+        try:
+            with conn, conn.cursor() as cur:
+                cur.execute("SET LOCAL hnsw.ef_search = %s", (max(PGVECTOR_EF_SEARCH, k),))
+                if class_id is not None and PGVECTOR_ITERATIVE_SCAN != "off":
+                    # keep scanning the index until k rows pass the class filter
+                    cur.execute("SET LOCAL hnsw.iterative_scan = %s", (PGVECTOR_ITERATIVE_SCAN,))
+                cur.execute(TOP_K_SQL.format(class_filter=class_filter), params)
+                rows = cur.fetchall()
+        finally:
+            pool.putconn(conn)
+
+        scores = [[] for _ in queries]
+        student_ids = [[] for _ in queries]
+        for ord_, student_id, score in rows:
+            scores[ord_ - 1].append(float(score))
+            student_ids[ord_ - 1].append(student_id)
+        return scores, student_ids
+
+
+class PgVectorClassGalleries:
+    """Same for_class()/global_gallery interface as embeddings_comparator.ClassPartitionedGallery."""
+
+    def __init__(self, fallback_to_global=False):
+        self.global_gallery = PgVectorGallery()
+        self.fallback_to_global = fallback_to_global
+        self.shards = {}  # nothing held in memory; kept for status reporting
+
+    def for_class(self, class_id):
+        try:
+            class_id = int(class_id)
+        except (TypeError, ValueError):
+            pass
+        return PgVectorGallery(class_id, self.fallback_to_global)
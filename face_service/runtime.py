@@ -0,0 +1,56 @@
+"""
+Process setup for serving face_service behind a pre-fork server (gunicorn.conf.py).
+
+The master imports service.py once (preload_app), which loads the YOLO weights and, when it is
+fork-safe, the InsightFace sessions; workers forked from it share those pages copy-on-write.
+after_fork() then applies the per-worker intra-op thread limit and recreates the state that
+must not cross a fork (threads, sockets, locks).
+"""
+
+import os
+
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))                 # per-worker threads; 0 = library defaults
+PREFORK = os.getenv("FACE_SERVICE_PREFORK", "false").lower() == "true"    # set by gunicorn.conf.py
+
+
+def onnx_fork_safe():
+    """onnxruntime starts no pool threads with one intra-op thread, so such sessions survive fork."""
+    return INTRA_OP_THREADS == 1
+
+
+def load_recognition_before_fork():
+    """Whether service.py should load (and warm up) InsightFace at import time."""
+    return not PREFORK or onnx_fork_safe()
+
+
+def limit_threads(threads=INTRA_OP_THREADS):
+    """Cap torch and OpenCV intra-op threads for this process (no-op for 0)."""
+    if threads <= 0:
+        return
+    import cv2
+    import torch
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+
+
+def after_fork():
+    """Run in every worker right after it is forked from the preloaded master."""
+    from embeddings_generator import model_manager
+    from jobs import job_queue
+    from web_client import web_client
+    from service import load_embeddings  # the real module, or service.py's stand-in if it failed to import
+
+    limit_threads()
+
+    if not load_recognition_before_fork():
+        # multi-threaded onnxruntime sessions can't be inherited: each worker builds its own
+        model_manager.reset()
+        try:
+            model_manager.warmup()
+        except Exception as e:
+            print(f"Warning: Failed to warm up recognition model: {e}")
+
+    web_client.reset()
+    job_queue.recover()
+    load_embeddings.refresher.restart()
+    print(f"[INFO] Worker {os.getpid()} ready (intra-op threads: {INTRA_OP_THREADS or 'default'})")
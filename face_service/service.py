@@ -1,14 +1,20 @@
 import os
-from embeddings_comparator import match_students
+import json
+import math
+from embeddings_comparator import match_students, fuse_frame_matches, is_empty, Gallery, ClassPartitionedGallery
 from flask import Flask, request, jsonify
 import cv2
 import numpy as np
-from detector import detect_faces  
+from batching import detect_frames, embed_faces
+import batching
 from utilities.image_path import get_temp_image_path
 from drive_downloader import download_image
-from embeddings_generator import generate_bulk_embeddings
-import requests
+from embeddings_generator import generate_bulk_embeddings, model_manager
+from web_client import web_client
+from jobs import job_queue, QueueFullError
+from admission import admission, ADMISSION_ASYNC_DEADLINE
 from functools import wraps
+import runtime
 
 # Import load_embeddings but handle errors gracefully
 try:
@@ -17,15 +23,75 @@ except Exception as e:
     print(f"Warning: Failed to load embeddings on startup: {e}")
     # Create a mock load_embeddings module if import fails
     class MockLoadEmbeddings:
-        embeddings = []
+        class _Snapshot:
+            embeddings = {}
+            gallery = Gallery.from_dict({})
+            global_index = gallery
+            class_galleries = ClassPartitionedGallery(gallery)
+
+        class _Refresher:
+            def status(self):
+                return {"last_refresh_ok": False, "last_error": "load_embeddings failed to import"}
+
+            def restart(self):
+                pass
+
+        refresher = _Refresher()
+
+        def current(self):
+            return self._Snapshot
     load_embeddings = MockLoadEmbeddings()
 
 
 app = Flask(__name__)
 
+# Load and warm up the recognition model once per process, before the first request
+# (under gunicorn with multi-threaded onnxruntime sessions, each worker does this after fork)
+if runtime.load_recognition_before_fork():
+    try:
+        model_manager.warmup()
+    except Exception as e:
+        print(f"Warning: Failed to warm up recognition model: {e}")
+
 # Get API key from environment
 API_KEY = os.getenv('PUBLIC_API_KEY', 'default-insecure-key')
-WEB_SERVICE_URL = os.getenv('WEB_SERVICE_URL', 'http://web:5000')
+# Default for process_with_attendance when the request does not say (async=true|false)
+ASYNC_PROCESSING = os.getenv('ASYNC_PROCESSING', 'false').lower() == 'true'
+# Multi-frame bursts: max frames per request, frames a student must be recognized in
+MAX_BURST_FRAMES = int(os.getenv('MAX_BURST_FRAMES', '8'))
+BURST_MIN_FRAMES = int(os.getenv('BURST_MIN_FRAMES', '0'))  # 0 = a majority of the burst's frames
+# Students per /public/api/mark-attendance/bulk call
+ATTENDANCE_CHUNK_SIZE = int(os.getenv('ATTENDANCE_CHUNK_SIZE', '100'))
+# Face crops per /process_faces_with_attendance request (edge detection on the Pi)
+MAX_UPLOAD_FACES = int(os.getenv('MAX_UPLOAD_FACES', '64'))
+
+
+def wants_async():
+    return request.form.get('async', request.args.get('async', str(ASYNC_PROCESSING))).lower() in ('1', 'true', 'yes')
+
+
+def overloaded_response(ticket):
+    """429 with Retry-After for a request the admission controller turned away."""
+    response = jsonify({
+        "error": "Face service is overloaded, retry later",
+        "retry_after": ticket.retry_after,
+        "estimated_seconds": round(ticket.estimated_seconds, 2),
+        "admission": admission.status()
+    })
+    response.headers['Retry-After'] = str(ticket.retry_after)
+    return response, 429
+
+def queue_full_response(error):
+    """429 with Retry-After when the async job queue is full: roughly the time to drain it."""
+    drain_seconds = job_queue.depth() * admission.timings["frame"] / max(1, job_queue.workers)
+    retry_after = max(1, math.ceil(drain_seconds))
+    response = jsonify({
+        "error": str(error),
+        "retry_after": retry_after,
+        "queue": job_queue.status()
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
 
 def require_api_key(f):
     """Decorator to validate API key in request headers"""
@@ -48,11 +114,11 @@ def process():
     npimg = np.frombuffer(file.read(), np.uint8)
     img = cv2.imdecode(npimg, cv2.IMREAD_COLOR)
 
-    faces = detect_faces(img)
+    faces = detect_frames([img])[0]
     
-    embeddings = generate_bulk_embeddings(faces)
+    embeddings = generate_bulk_embeddings(faces, embed_fn=embed_faces)
     
-    student_embeddings = load_embeddings.embeddings
+    student_embeddings = load_embeddings.current().global_index
     
     predicted_students, similar_students_all = match_students(
         list(embeddings.values()),
@@ -65,6 +131,57 @@ def process():
     })
 
 
+def mark_attendance_bulk(student_ids, period_id, status="present"):
+    """
+    Mark attendance for student_ids through /public/api/mark-attendance/bulk.
+    Large frames are split into ATTENDANCE_CHUNK_SIZE batches sent concurrently over the pooled client.
+    Returns one entry per student: status "marked", "failed" or "error".
+    """
+    chunks = [student_ids[i:i + ATTENDANCE_CHUNK_SIZE] for i in range(0, len(student_ids), ATTENDANCE_CHUNK_SIZE)]
+    marked_attendance = [m for chunk in web_client.map(lambda c: _mark_attendance_chunk(c, period_id, status), chunks)
+                         for m in chunk]
+    if marked_attendance:
+        print(f"Attendance marked for {sum(1 for m in marked_attendance if m['status'] == 'marked')} "
+              f"of {len(student_ids)} students in period {period_id}")
+    return marked_attendance
+
+
+def _mark_attendance_chunk(student_ids, period_id, status):
+    try:
+        # the bulk upsert is idempotent, so it is safe to retry
+        response = web_client.post(
+            "/public/api/mark-attendance/bulk",
+            idempotent=True,
+            json={
+                "period_id": int(period_id),
+                "records": [{"student_id": int(s), "status": status} for s in student_ids]
+            }
+        )
+    except Exception as e:
+        print(f"Error marking attendance for period {period_id}: {e}")
+        return [{"student_id": s, "status": "error", "error": str(e)} for s in student_ids]
+    
+    if response.status_code != 200:
+        print(f"Failed to mark attendance for period {period_id}: {response.text}")
+        return [{"student_id": s, "status": "failed", "error": response.text} for s in student_ids]
+    
+    marked_attendance = []
+    for result in response.json().get("results", []):
+        if result["result"] in ("created", "updated"):
+            marked_attendance.append({
+                "student_id": result["student_id"],
+                "status": "marked",
+                "period_id": int(period_id)
+            })
+        else:
+            marked_attendance.append({
+                "student_id": result["student_id"],
+                "status": "failed",
+                "error": result.get("error")
+            })
+    return marked_attendance
+
+
 @app.route('/process_with_attendance', methods=['POST'])
 @require_api_key
 def process_with_attendance():
@@ -76,7 +193,12 @@ def process_with_attendance():
     - period_id: ID of the period
     - class_id: ID of the class
     - timestamp: timestamp of capture (optional)
+    - async: "true" to enqueue the frame and return 202 with a job id (default: ASYNC_PROCESSING)
+    
+    Returns 429 with a Retry-After header when the frame could not be processed within the
+    admission deadline given the work already in flight.
     """
+    ticket = None
     try:
         # Check if image file is present
         if 'image' not in request.files:
@@ -88,6 +210,12 @@ def process_with_attendance():
         if not period_id or not class_id:
             return jsonify({"error": "period_id and class_id are required"}), 400
         
+        # Shed load before decoding anything
+        run_async = wants_async()
+        ticket = admission.admit(frames=1, deadline=ADMISSION_ASYNC_DEADLINE if run_async else None)
+        if not ticket.admitted:
+            return overloaded_response(ticket)
+        
         # Decode image
         file = request.files['image']
         npimg = np.frombuffer(file.read(), np.uint8)
@@ -97,91 +225,390 @@ def process_with_attendance():
         if img is None:
             return jsonify({"error": "Failed to decode image"}), 400
         
-        # Detect faces and generate embeddings
-        faces = detect_faces(img)
+        if run_async:
+            try:
+                job_id = job_queue.submit(ticket.run, process_attendance_frame, img, period_id, class_id)
+            except QueueFullError as e:
+                return queue_full_response(e)
+            ticket = None  # released by the job worker
+            
+            response = jsonify({
+                "message": "Frame queued for processing",
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "queue_depth": job_queue.depth()
+            })
+            response.headers['Location'] = f"/jobs/{job_id}"
+            return response, 202
         
-        if not faces:
-            return jsonify({
-                "message": "No faces detected in image",
-                "predicted_students": [],
-                "marked_attendance": []
-            }), 200
+        result, status_code = ticket.run(process_attendance_frame, img, period_id, class_id)
+        return jsonify(result), status_code
+    
+    except Exception as e:
+        print(f"Error in process_with_attendance: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+    
+    finally:
+        if ticket is not None:
+            ticket.release()
+
 
+def process_attendance_frame(img, period_id, class_id):
+    """
+    Detect, embed and match the faces in a decoded frame, then mark attendance.
+    Returns (response dict, HTTP status code); runs inline or on a job worker.
+    """
+    # Detect faces (micro-batched with concurrent requests)
+    with admission.stage("detect"):
+        faces = detect_frames([img])[0]
+    
+    return process_attendance_faces(faces, period_id, class_id)
+
+
+def process_attendance_faces(faces, period_id, class_id):
+    """
+    Embed and match detected faces (from detect_frames or crops uploaded by the Pi), then mark attendance.
+    Returns (response dict, HTTP status code).
+    """
+    if not faces:
+        return {
+            "message": "No faces detected in image",
+            "predicted_students": [],
+            "marked_attendance": []
+        }, 200
+    
+    with admission.stage("embed"):
+        embeddings = generate_bulk_embeddings(faces, embed_fn=embed_faces)
+    
+    # Only search students enrolled in the requesting class
+    student_embeddings = load_embeddings.current().class_galleries.for_class(class_id)
+    
+    if is_empty(student_embeddings):
+        return {
+            "message": f"No reference embeddings loaded for class {class_id}",
+            "predicted_students": [],
+            "marked_attendance": []
+        }, 200
+    
+    with admission.stage("match"):
+        predicted_students, similar_students_all = match_students(
+            list(embeddings.values()),
+            student_embeddings
+        )
+    
+    # Mark attendance for all predicted students with one bulk call
+    with admission.stage("mark"):
+        marked_attendance = mark_attendance_bulk(
+            [s for s in dict.fromkeys(predicted_students) if s is not None],
+            period_id
+        )
+    
+    return {
+        "message": f"Processed image: {len(predicted_students)} students identified",
+        "predicted_students": predicted_students,
+        "marked_attendance": marked_attendance,
+        "similar_students_all": similar_students_all
+    }, 200
+
+
+@app.route('/process_faces_with_attendance', methods=['POST'])
+@require_api_key
+def process_faces_with_attendance():
+    """
+    Mark attendance from face crops detected on the Raspberry Pi (server-side detection is skipped).
+    
+    Expects:
+    - faces: 1..MAX_UPLOAD_FACES padded face crops (multipart, repeated field)
+    - boxes: JSON list, one entry per crop in the same order, in full-frame pixel coordinates:
+      {"box": [x1, y1, x2, y2], "crop": [x1, y1, x2, y2], "kpts": [[x, y] x 5] (optional), "conf": float (optional)}
+      where "box" is the face and "crop" the padded region that was uploaded
+    - period_id: ID of the period
+    - class_id: ID of the class
+    - async: "true" to enqueue the crops and return 202 with a job id (default: ASYNC_PROCESSING)
+    """
+    ticket = None
+    try:
+        files = request.files.getlist('faces')
+        if not files:
+            return jsonify({"error": "Missing face crops"}), 400
+        if len(files) > MAX_UPLOAD_FACES:
+            return jsonify({"error": f"At most {MAX_UPLOAD_FACES} faces per request"}), 400
+        
+        period_id = request.form.get('period_id')
+        class_id = request.form.get('class_id')
+        
+        if not period_id or not class_id:
+            return jsonify({"error": "period_id and class_id are required"}), 400
+        
+        try:
+            boxes = json.loads(request.form.get('boxes', ''))
+        except ValueError:
+            return jsonify({"error": "boxes must be a JSON list"}), 400
+        if not isinstance(boxes, list) or len(boxes) != len(files):
+            return jsonify({"error": "boxes must have one entry per face crop"}), 400
+        
+        # The crops of one captured frame count as one frame
+        run_async = wants_async()
+        ticket = admission.admit(frames=1, deadline=ADMISSION_ASYNC_DEADLINE if run_async else None)
+        if not ticket.admitted:
+            return overloaded_response(ticket)
+        
+        crops = []
+        for file in files:
+            crop = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+            if crop is None:
+                return jsonify({"error": f"Failed to decode face crop {file.filename}"}), 400
+            crops.append(crop)
+        
+        try:
+            faces = faces_from_crops(crops, boxes)
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({"error": f"Invalid boxes: {e}"}), 400
+        
+        if run_async:
+            try:
+                job_id = job_queue.submit(ticket.run, process_attendance_faces, faces, period_id, class_id)
+            except QueueFullError as e:
+                return queue_full_response(e)
+            ticket = None  # released by the job worker
             
+            response = jsonify({
+                "message": f"{len(faces)} face crops queued for processing",
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "queue_depth": job_queue.depth()
+            })
+            response.headers['Location'] = f"/jobs/{job_id}"
+            return response, 202
         
-        embeddings = generate_bulk_embeddings(faces)
+        result, status_code = ticket.run(process_attendance_faces, faces, period_id, class_id)
+        return jsonify(result), status_code
+    
+    except Exception as e:
+        print(f"Error in process_faces_with_attendance: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+    
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+def faces_from_crops(crops, boxes):
+    """
+    Turn uploaded crops and their full-frame boxes into detect_faces()-style dicts: each crop
+    becomes the "frame" and the face box / keypoints are shifted into its coordinates, so the
+    crops go through the same alignment and batched embedding as server-side detections.
+    Edge boxes without keypoints (Haar) are tighter than YOLO boxes, so they are always aligned
+    with landmarker points instead of the YOLO box prior.
+    """
+    faces = []
+    for crop, entry in zip(crops, boxes):
+        cx1, cy1, _, _ = [int(round(v)) for v in entry["crop"]]
+        x1, y1, x2, y2 = [int(round(v)) for v in entry["box"]]
+        h, w = crop.shape[:2]
+        box = [max(0, x1 - cx1), max(0, y1 - cy1), min(w - 1, x2 - cx1), min(h - 1, y2 - cy1)]
+        if box[2] <= box[0] or box[3] <= box[1]:
+            raise ValueError(f"box {entry['box']} is outside its crop {entry['crop']}")
         
-        student_embeddings = load_embeddings.embeddings
+        kpts = entry.get("kpts")
+        if kpts is not None:
+            kpts = np.asarray(kpts, dtype=np.float32).reshape(5, 2) - np.array([cx1, cy1], dtype=np.float32)
         
-        if not student_embeddings:
-            return jsonify({
-                "message": "No reference embeddings loaded",
-                "predicted_students": [],
-                "marked_attendance": []
-            }), 200
+        faces.append({
+            "image": crop[box[1]:box[3] + 1, box[0]:box[2] + 1],
+            "frame": crop,
+            "box": box,
+            "conf": float(entry.get("conf", 1.0)),
+            "kpts": kpts,
+            "file_id": None,
+            "estimate_landmarks": True,
+        })
+    return faces
+
+
+@app.route('/process_burst_with_attendance', methods=['POST'])
+@require_api_key
+def process_burst_with_attendance():
+    """
+    Process a burst of frames of the same classroom and mark attendance once.
+    
+    Expects:
+    - images: 1..MAX_BURST_FRAMES image files (multipart, repeated field)
+    - period_id: ID of the period
+    - class_id: ID of the class
+    - min_frames: frames a student's face track must be recognized in
+      (optional, default BURST_MIN_FRAMES; 0 = a majority of the frames)
+    - async: "true" to enqueue the burst and return 202 with a job id (default: ASYNC_PROCESSING)
+    
+    Returns 429 with a Retry-After header when the service is too busy (see process_with_attendance).
+    """
+    ticket = None
+    try:
+        files = request.files.getlist('images')
+        if not files:
+            return jsonify({"error": "Missing images"}), 400
+        if len(files) > MAX_BURST_FRAMES:
+            return jsonify({"error": f"At most {MAX_BURST_FRAMES} frames per burst"}), 400
         
-        predicted_students, similar_students_all = match_students(
-            embeddings,
-            student_embeddings
-        )
+        period_id = request.form.get('period_id')
+        class_id = request.form.get('class_id')
         
-        # Mark attendance for predicted students
-        marked_attendance = []
-        headers = {"X-API-Key": API_KEY}
+        if not period_id or not class_id:
+            return jsonify({"error": "period_id and class_id are required"}), 400
+        
+        try:
+            min_frames = int(request.form.get('min_frames', BURST_MIN_FRAMES))
+        except ValueError:
+            return jsonify({"error": "min_frames must be an integer"}), 400
         
-        for student_id in predicted_students:
+        run_async = wants_async()
+        ticket = admission.admit(frames=len(files), deadline=ADMISSION_ASYNC_DEADLINE if run_async else None)
+        if not ticket.admitted:
+            return overloaded_response(ticket)
+        
+        # Decode images
+        images = []
+        for file in files:
+            img = cv2.imdecode(np.frombuffer(file.read(), np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                return jsonify({"error": f"Failed to decode image {file.filename}"}), 400
+            images.append(img)
+        
+        if run_async:
             try:
-                # Call web service API to mark attendance
-                attendance_url = f"{WEB_SERVICE_URL}/public/api/mark-attendance"
-                attendance_data = {
-                    "student_id": int(student_id),
-                    "period_id": int(period_id),
-                    "status": "present"
-                }
-                
-                response = requests.post(
-                    attendance_url,
-                    json=attendance_data,
-                    headers=headers,
-                    timeout=10
-                )
-                
-                if response.status_code == 201:
-                    marked_attendance.append({
-                        "student_id": student_id,
-                        "status": "marked",
-                        "period_id": int(period_id)
-                    })
-                    print(f"Attendance marked for student {student_id} in period {period_id}")
-                else:
-                    marked_attendance.append({
-                        "student_id": student_id,
-                        "status": "failed",
-                        "error": response.text
-                    })
-                    print(f"Failed to mark attendance for student {student_id}: {response.text}")
+                job_id = job_queue.submit(ticket.run, process_attendance_burst, images, period_id, class_id, min_frames)
+            except QueueFullError as e:
+                return queue_full_response(e)
+            ticket = None  # released by the job worker
             
-            except Exception as e:
-                marked_attendance.append({
-                    "student_id": student_id,
-                    "status": "error",
-                    "error": str(e)
-                })
-                print(f"Error marking attendance for student {student_id}: {e}")
-        
-        return jsonify({
-            "message": f"Processed image: {len(predicted_students)} students identified",
-            "predicted_students": predicted_students,
-            "marked_attendance": marked_attendance,
-            "similar_students_all": similar_students_all
-        }), 200
+            response = jsonify({
+                "message": f"Burst of {len(images)} frames queued for processing",
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}",
+                "queue_depth": job_queue.depth()
+            })
+            response.headers['Location'] = f"/jobs/{job_id}"
+            return response, 202
+        
+        result, status_code = ticket.run(process_attendance_burst, images, period_id, class_id, min_frames)
+        return jsonify(result), status_code
     
     except Exception as e:
-        print(f"Error in process_with_attendance: {e}")
+        print(f"Error in process_burst_with_attendance: {e}")
         import traceback
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
     
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+
+def process_attendance_burst(images, period_id, class_id, min_frames=0):
+    """
+    Detect faces in all frames as one batch, embed every face in one batch, match them together
+    and fuse the per-face matches across frames before marking attendance once.
+    Returns (response dict, HTTP status code).
+    """
+    frames = len(images)
+    with admission.stage("detect", frames):
+        faces = [face for frame_faces in detect_frames(images) for face in frame_faces]
+    
+    if not faces:
+        return {
+            "message": f"No faces detected in {len(images)} frames",
+            "frames": len(images),
+            "predicted_students": [],
+            "marked_attendance": []
+        }, 200
+    
+    with admission.stage("embed", frames):
+        embeddings = generate_bulk_embeddings(faces, embed_fn=embed_faces)
+    
+    # Only search students enrolled in the requesting class
+    student_embeddings = load_embeddings.current().class_galleries.for_class(class_id)
+    
+    if is_empty(student_embeddings):
+        return {
+            "message": f"No reference embeddings loaded for class {class_id}",
+            "frames": len(images),
+            "predicted_students": [],
+            "marked_attendance": []
+        }, 200
+    
+    with admission.stage("match", frames):
+        predicted, similar_all = match_students(list(embeddings.values()), student_embeddings)
+        fused = fuse_frame_matches(
+            [faces[idx]["frame_index"] for idx in embeddings],
+            [faces[idx]["box"] for idx in embeddings],
+            predicted,
+            similar_all,
+            min_frames=min_frames,
+            frames=frames
+        )
+    predicted_students = [m["student_id"] for m in fused]
+    
+    with admission.stage("mark", frames):
+        marked_attendance = mark_attendance_bulk(predicted_students, period_id)
+    
+    return {
+        "message": f"Processed burst of {len(images)} frames: {len(predicted_students)} students identified",
+        "frames": len(images),
+        "faces": len(faces),
+        "predicted_students": predicted_students,
+        "matches": fused,
+        "marked_attendance": marked_attendance
+    }, 200
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_job(job_id):
+    """Status and result of an asynchronous process_with_attendance job"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+
+@app.route('/jobs', methods=['GET'])
+@require_api_key
+def jobs_status():
+    """Job queue depth, capacity and counters"""
+    return jsonify(job_queue.status()), 200
+    
+
+@app.route('/admission/status', methods=['GET'])
+@require_api_key
+def admission_status():
+    """Frames in flight, admission counters and per-stage service times (seconds per frame)"""
+    return jsonify(admission.status()), 200
+
+
+@app.route('/gallery/status', methods=['GET'])
+@require_api_key
+def gallery_status():
+    """Size of the published reference gallery and stats of the last refresh"""
+    return jsonify(load_embeddings.refresher.status()), 200
+
+
+@app.route('/inference/status', methods=['GET'])
+@require_api_key
+def inference_status():
+    """Micro-batching queues: depth, batch sizes and time spent in batched forward passes"""
+    return jsonify(batching.status()), 200
+
+
+@app.route('/web_client/status', methods=['GET'])
+@require_api_key
+def web_client_status():
+    """Call counts and timings of face_service -> web service requests"""
+    return jsonify(web_client.status()), 200
+
 
 @app.route('/generate_embeddings', methods=['POST'])
 def generate_embeddings():
@@ -224,5 +651,8 @@ def generate_embeddings():
    
 
 if __name__ == '__main__':
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
     print("Starting face_service on port 8000...")
-    app.run(host="0.0.0.0", port=8000, debug=True)
\ No newline at end of file
+    runtime.limit_threads()
+    job_queue.recover()
+    app.run(host="0.0.0.0", port=8000, debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true', threaded=True)
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""
+Box geometry helpers for the face detector: IoU, confidence-weighted clustering and NMS.
+Boxes are xyxy with inclusive pixel coordinates (hence the +1 in widths/heights).
+"""
+
+import numpy as np
+
+
+def iou(a, b):
+    x1 = max(a[0], b[0]); y1 = max(a[1], b[1])
+    x2 = min(a[2], b[2]); y2 = min(a[3], b[3])
+    w = max(0, x2 - x1 + 1); h = max(0, y2 - y1 + 1)
+    inter = w * h
+    area_a = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
+    area_b = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
+    union = area_a + area_b - inter
+    return inter / union if union > 0 else 0.0
+
+def iou_matrix(a, b=None):
+    """
+    Pairwise IoU between Nx4 boxes a and Mx4 boxes b (b defaults to a). Returns an NxM float array.
+    """
+    a = np.asarray(a, dtype=float).reshape(-1, 4)
+    b = a if b is None else np.asarray(b, dtype=float).reshape(-1, 4)
+    # intersection width/height, computed in place to keep temporaries down
+    iw = np.minimum(a[:, None, 2], b[None, :, 2])
+    iw -= np.maximum(a[:, None, 0], b[None, :, 0])
+    iw += 1
+    np.clip(iw, 0, None, out=iw)
+    ih = np.minimum(a[:, None, 3], b[None, :, 3])
+    ih -= np.maximum(a[:, None, 1], b[None, :, 1])
+    ih += 1
+    np.clip(ih, 0, None, out=ih)
+    inter = np.multiply(iw, ih, out=iw)
+    area_a = (a[:, 2] - a[:, 0] + 1) * (a[:, 3] - a[:, 1] + 1)
+    area_b = (b[:, 2] - b[:, 0] + 1) * (b[:, 3] - b[:, 1] + 1)
+    union = np.add(area_a[:, None], area_b[None, :], out=ih)
+    union -= inter
+    out = np.zeros_like(inter)
+    np.divide(inter, union, out=out, where=union > 0)
+    return out
+
+def weighted_cluster(boxes, confs, iou_thresh=0.3):
+    """
+    Cluster boxes by IoU >= iou_thresh. For each cluster compute confidence-weighted average box.
+    Returns merged_boxes (xyxy ints) and merged_confs (floats).
+    Reference pure-Python implementation; see weighted_cluster_vectorized.
+    """
+    if not boxes:
+        return [], []
+    boxes = [list(b) for b in boxes]
+    confs = [float(c) for c in confs]
+    idxs = list(range(len(boxes)))
+    merged_boxes = []
+    merged_confs = []
+    while idxs:
+        # pick index of highest confidence remaining
+        seed = max(idxs, key=lambda i: confs[i])
+        cluster = [seed]
+        others = [i for i in idxs if i != seed]
+        for j in others:
+            if iou(boxes[seed], boxes[j]) >= iou_thresh:
+                cluster.append(j)
+        # weighted average
+        weights = np.array([confs[i] for i in cluster], dtype=float)
+        coords = np.array([boxes[i] for i in cluster], dtype=float)
+        wsum = weights.sum() if weights.sum() > 0 else 1.0
+        avg = (weights[:, None] * coords).sum(axis=0) / wsum
+        x1, y1, x2, y2 = avg
+        merged_boxes.append([int(round(x1)), int(round(y1)), int(round(x2)), int(round(y2))])
+        merged_confs.append(float(max(confs[i] for i in cluster)))
+        # remove clustered indices
+        idxs = [i for i in idxs if i not in cluster]
+    return merged_boxes, merged_confs
+
+def weighted_cluster_vectorized(boxes, confs, iou_thresh=0.3):
+    """
+    Same clustering as weighted_cluster, but computes the pairwise IoU matrix once
+    and merges clusters with array ops. Returns identical merged boxes/confs as numpy arrays
+    (Kx4 int, K float).
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    confs = np.asarray(confs, dtype=float).reshape(-1)
+    if len(boxes) == 0:
+        return np.zeros((0, 4), dtype=int), np.zeros((0,))
+
+    ious = iou_matrix(boxes)
+    # stable sort keeps the lowest index first on ties, like max() over an ascending list
+    order = np.argsort(-confs, kind="stable")
+    remaining = np.ones(len(boxes), dtype=bool)
+    merged_boxes = []
+    merged_confs = []
+    for seed in order:
+        if not remaining[seed]:
+            continue
+        members = remaining & (ious[seed] >= iou_thresh)
+        members[seed] = False
+        # seed first, then the others in ascending index order (same summation order as weighted_cluster)
+        cluster = np.concatenate(([seed], np.flatnonzero(members)))
+        weights = confs[cluster]
+        wsum = weights.sum() if weights.sum() > 0 else 1.0
+        merged_boxes.append((weights[:, None] * boxes[cluster]).sum(axis=0) / wsum)
+        merged_confs.append(confs[cluster].max())
+        remaining[cluster] = False
+    return np.rint(np.array(merged_boxes)).astype(int), np.array(merged_confs, dtype=float)
+
+def nms(boxes, confs, score_thresh, iou_thresh):
+    """
+    Greedy NMS equivalent to cv2.dnn.NMSBoxes on xyxy boxes.
+    Returns kept indices ordered by descending confidence.
+    """
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    confs = np.asarray(confs, dtype=float).reshape(-1)
+    candidates = np.flatnonzero(confs > score_thresh)
+    if len(candidates) == 0:
+        return np.zeros((0,), dtype=int)
+    candidates = candidates[np.argsort(-confs[candidates], kind="stable")]
+    ious = iou_matrix(boxes[candidates])
+    suppressed = np.zeros(len(candidates), dtype=bool)
+    keep = []
+    for i in range(len(candidates)):
+        if suppressed[i]:
+            continue
+        keep.append(candidates[i])
+        suppressed |= ious[i] > iou_thresh
+    return np.array(keep, dtype=int)
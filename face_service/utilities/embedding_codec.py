@@ -0,0 +1,74 @@
+"""
+Reader for the web service's binary embeddings format (see web/app/utils/embedding_codec.py).
+
+    magic b"EMB1" | uint32 LE header length | JSON header | padding to 16 bytes |
+    records: int64 embedding_id | int64 student_id | int64 class_id (-1 = none) | dim x float32/float16 (LE) |
+    trailer: uint64 LE record count | b"EMB1-END"
+"""
+
+import json
+import struct
+import numpy as np
+
+EMBEDDINGS_MEDIA_TYPE = "application/x-embeddings"
+MAGIC = b"EMB1"
+END_MARKER = b"EMB1-END"
+TRAILER_SIZE = 8 + len(END_MARKER)
+ALIGNMENT = 16
+NO_CLASS = -1
+DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+
+def record_dtype(dim, dtype):
+    return np.dtype([
+        ("embedding_id", "<i8"),
+        ("student_id", "<i8"),
+        ("class_id", "<i8"),
+        ("vector", DTYPES[dtype], (dim,)),
+    ])
+
+
+def unpack_embeddings(payload):
+    """
+    Decode a binary embeddings response with one np.frombuffer call.
+    Returns (header, records, vectors): records is a structured array with
+    embedding_id / student_id / class_id, vectors is the matching (N, D) float32 array.
+    Raises ValueError for a body without its trailer or with a record count that doesn't
+    match (a response cut short mid-stream), so a partial gallery is never published.
+    """
+    if payload[:4] != MAGIC:
+        raise ValueError("Not a binary embeddings payload")
+    (header_len,) = struct.unpack_from("<I", payload, 4)
+    header = json.loads(bytes(payload[8:8 + header_len]).decode("utf-8"))
+
+    offset = 8 + header_len
+    offset += (-offset) % ALIGNMENT
+    end = len(payload) - TRAILER_SIZE
+    if end < offset or bytes(payload[end + 8:]) != END_MARKER:
+        raise ValueError("Truncated binary embeddings payload (missing trailer)")
+    (count,) = struct.unpack_from("<Q", payload, end)
+
+    dim = header["dim"]
+    dtype = record_dtype(dim, header["dtype"])
+    if end - offset != count * dtype.itemsize:
+        raise ValueError(f"Truncated binary embeddings payload: trailer says {count} records, "
+                         f"body holds {(end - offset) / dtype.itemsize:g}")
+    if count == 0:
+        return header, np.zeros((0,), dtype=dtype), np.zeros((0, dim), dtype=np.float32)
+
+    records = np.frombuffer(payload, dtype=dtype, count=count, offset=offset)
+    return header, records, np.ascontiguousarray(records["vector"], dtype=np.float32)
+
+
+def to_columns_payload(header, records, vectors):
+    """
+    The header fields plus "columns": (embedding_ids, student_ids, class_ids, vectors) as arrays
+    (class_ids an object array with None for rows without a class), for building a gallery
+    without going through one Python dict per row.
+    """
+    data = dict(header)
+    class_ids = records["class_id"].astype(object)
+    class_ids[records["class_id"] == NO_CLASS] = None
+    data["columns"] = (records["embedding_id"], records["student_id"], class_ids, vectors)
+    data["count"] = len(records)
+    return data
@@ -0,0 +1,125 @@
+"""
+Shared HTTP client for face_service -> web service calls.
+
+- one requests.Session with a keep-alive connection pool (no TCP/TLS setup per call)
+- bounded concurrency for fan-out calls (map over a small thread pool)
+- retries with exponential backoff and full jitter, only for idempotent requests
+- per-call timing, aggregated per path (see WebClient.status())
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+WEB_SERVICE_URL = os.getenv("WEB_SERVICE_URL", "http://web:5000")
+API_KEY = os.getenv("PUBLIC_API_KEY", "default-insecure-key")
+WEB_CLIENT_POOL_SIZE = int(os.getenv("WEB_CLIENT_POOL_SIZE", "16"))         # keep-alive connections
+WEB_CLIENT_CONCURRENCY = int(os.getenv("WEB_CLIENT_CONCURRENCY", "8"))      # parallel calls in map()
+WEB_CLIENT_RETRIES = int(os.getenv("WEB_CLIENT_RETRIES", "3"))              # extra attempts for idempotent calls
+WEB_CLIENT_BACKOFF = float(os.getenv("WEB_CLIENT_BACKOFF", "0.2"))          # base delay (seconds), doubled per attempt
+WEB_CLIENT_BACKOFF_MAX = float(os.getenv("WEB_CLIENT_BACKOFF_MAX", "5"))
+WEB_CLIENT_TIMEOUT = float(os.getenv("WEB_CLIENT_TIMEOUT", "10"))
+
+RETRY_STATUSES = (429, 502, 503, 504)
+
+
+class WebClient:
+
+    def __init__(self, base_url=WEB_SERVICE_URL, api_key=API_KEY, pool_size=WEB_CLIENT_POOL_SIZE,
+                 concurrency=WEB_CLIENT_CONCURRENCY, retries=WEB_CLIENT_RETRIES,
+                 backoff=WEB_CLIENT_BACKOFF, timeout=WEB_CLIENT_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._stats = {}
+        self.reset()
+
+    def reset(self):
+        """
+        Fresh session, connection pool and fan-out threads. Called in each worker after a
+        pre-fork server forks, so workers never share the parent's keep-alive sockets.
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["X-API-Key"] = self.api_key
+
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="web-client")
+        self._stats_lock = threading.Lock()
+
+    def request(self, method, path, idempotent=False, **kwargs):
+        """
+        Send one request and return the response (raise_for_status is left to the caller).
+        Idempotent requests are retried on connection errors, timeouts and 429/502/503/504.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        attempts = 1 + (self.retries if idempotent else 0)
+        start = time.perf_counter()
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    self._record(method, path, start, attempt, error=True)
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last:
+                    self._record(method, path, start, attempt, error=response.status_code >= 400)
+                    return response
+            time.sleep(self._backoff_delay(attempt))
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, idempotent=True, **kwargs)
+
+    def post(self, path, idempotent=False, **kwargs):
+        return self.request("POST", path, idempotent=idempotent, **kwargs)
+
+    def map(self, fn, items):
+        """Run fn(item) for every item on the shared pool (bounded concurrency); results in input order."""
+        items = list(items)
+        if len(items) <= 1:
+            return [fn(item) for item in items]
+        return list(self._executor.map(fn, items))
+
+    def _backoff_delay(self, attempt):
+        # full jitter: uniform in [0, min(max, base * 2^attempt)]
+        return random.uniform(0, min(WEB_CLIENT_BACKOFF_MAX, self.backoff * (2 ** attempt)))
+
+    def _record(self, method, path, start, retries, error=False):
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            s = self._stats.setdefault(f"{method} {path}", {
+                "calls": 0, "errors": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0
+            })
+            s["calls"] += 1
+            s["errors"] += int(error)
+            s["retries"] += retries
+            s["total_seconds"] += elapsed
+            s["max_seconds"] = max(s["max_seconds"], elapsed)
+            s["last_seconds"] = elapsed
+
+    def status(self):
+        """Per-path call counts and timings."""
+        with self._stats_lock:
+            return {
+                key: dict(s,
+                          avg_seconds=round(s["total_seconds"] / s["calls"], 4),
+                          total_seconds=round(s["total_seconds"], 4),
+                          max_seconds=round(s["max_seconds"], 4),
+                          last_seconds=round(s["last_seconds"], 4))
+                for key, s in self._stats.items()
+            }
+
+
+web_client = WebClient()
@@ -20,6 +20,23 @@ PUBLIC_API_KEY = os.getenv('PUBLIC_API_KEY', 'default-insecure-key')
 CLASS_ID = os.getenv('CLASS_ID', '1')  # Set class ID via environment variable
 CAPTURE_INTERVAL = int(os.getenv('CAPTURE_INTERVAL', '300'))  # 5 minutes in seconds
 POLL_INTERVAL = int(os.getenv('POLL_INTERVAL', '30'))  # Check for running period every 30 seconds
+ASYNC_UPLOAD = os.getenv('ASYNC_UPLOAD', 'true').lower() == 'true'  # Let the face service queue the frame (202 + job id)
+BURST_FRAMES = int(os.getenv('BURST_FRAMES', '1'))  # Frames per capture; >1 sends one burst request
+BURST_SPACING = float(os.getenv('BURST_SPACING', '0.3'))  # Seconds between burst frames
+SCENE_GATING = os.getenv('SCENE_GATING', 'false').lower() == 'true'  # Skip uploads while the scene is static
+SCENE_PIXEL_DELTA = int(os.getenv('SCENE_PIXEL_DELTA', '25'))  # Grey-level change that counts a pixel as changed
+SCENE_CHANGE_RATIO = float(os.getenv('SCENE_CHANGE_RATIO', '0.02'))  # Fraction of changed pixels that counts as a new scene
+SCENE_MAX_SKIPS = int(os.getenv('SCENE_MAX_SKIPS', '3'))  # Upload anyway after this many skipped captures
+SCENE_SIZE = (80, 60)  # Low-resolution reference frame (width, height)
+EDGE_FACE_DETECTION = os.getenv('EDGE_FACE_DETECTION', 'false').lower() == 'true'  # Detect faces here, upload only crops
+EDGE_DETECTOR_MODEL = os.getenv('EDGE_DETECTOR_MODEL', '')  # YuNet .onnx file; Haar cascade when empty or missing
+EDGE_HAAR_CASCADE = os.getenv('EDGE_HAAR_CASCADE', '')  # Haar cascade .xml; found automatically when empty
+HAAR_CASCADE_FILE = 'haarcascade_frontalface_default.xml'
+HAAR_CASCADE_DIRS = ['/usr/share/opencv4/haarcascades', '/usr/share/opencv/haarcascades']  # Debian / Raspberry Pi OS opencv-data
+EDGE_CROP_PADDING = float(os.getenv('EDGE_CROP_PADDING', '0.3'))  # Margin around each face, as a fraction of its size
+EDGE_MIN_FACE = int(os.getenv('EDGE_MIN_FACE', '24'))  # Smallest face (pixels) the edge detector reports
+EDGE_SCORE_THRESHOLD = float(os.getenv('EDGE_SCORE_THRESHOLD', '0.6'))  # YuNet confidence threshold
+EDGE_FALLBACK_FULL_FRAME = os.getenv('EDGE_FALLBACK_FULL_FRAME', 'true').lower() == 'true'  # Upload the frame when no face is found
 
 # Detect OS and camera index
 IS_WINDOWS = platform.system() == 'Windows'
@@ -35,6 +52,10 @@ class AttendanceCapture:
         self.current_period_id = None
         self.camera = None
         self.last_capture_time = 0
+        self.retry_at = None  # set when the face service answers 429 (overloaded)
+        self.scene_reference = None  # thumbnail of the last uploaded frame
+        self.scene_skips = 0
+        self.face_detector = None
         
     def log(self, message):
         """Print log message with timestamp"""
@@ -117,6 +138,211 @@ class AttendanceCapture:
             self.log(f"ERROR: Failed to capture image: {e}")
             return None
     
+    def capture_burst(self):
+        """Capture BURST_FRAMES frames BURST_SPACING seconds apart"""
+        frames = []
+        for i in range(BURST_FRAMES):
+            if i:
+                time.sleep(BURST_SPACING)
+            frame = self.capture_image()
+            if frame is not None:
+                frames.append(frame)
+        return frames
+    
+    def scene_thumbnail(self, frame):
+        """Small blurred greyscale copy of a frame; cheap to compare and insensitive to sensor noise"""
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, SCENE_SIZE, interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+    
+    def should_upload(self, frame):
+        """
+        Scene-change gate: compare the frame with the last uploaded one and skip the upload
+        when too few pixels changed, but never more than SCENE_MAX_SKIPS times in a row.
+        Returns (upload, thumbnail); pass the thumbnail to accept_scene() after a successful upload.
+        """
+        thumbnail = self.scene_thumbnail(frame)
+        if not SCENE_GATING or self.scene_reference is None:
+            return True, thumbnail
+        
+        changed = cv2.countNonZero(
+            cv2.threshold(cv2.absdiff(thumbnail, self.scene_reference), SCENE_PIXEL_DELTA, 255, cv2.THRESH_BINARY)[1]
+        ) / float(thumbnail.size)
+        
+        if changed >= SCENE_CHANGE_RATIO:
+            self.log(f"Scene changed ({changed:.1%} of pixels), uploading")
+            return True, thumbnail
+        if self.scene_skips >= SCENE_MAX_SKIPS:
+            self.log(f"Scene unchanged for {self.scene_skips} captures, uploading anyway")
+            return True, thumbnail
+        
+        self.scene_skips += 1
+        self.log(f"Scene unchanged ({changed:.1%} of pixels), skipping upload ({self.scene_skips}/{SCENE_MAX_SKIPS})")
+        return False, thumbnail
+    
+    def accept_scene(self, thumbnail):
+        """The frame was uploaded: it becomes the reference for the next comparison"""
+        self.scene_reference = thumbnail
+        self.scene_skips = 0
+    
+    def reset_scene(self):
+        self.scene_reference = None
+        self.scene_skips = 0
+    
+    def find_haar_cascade(self):
+        """Path of the frontal-face Haar cascade: EDGE_HAAR_CASCADE, the pip wheel's copy, or the distro's"""
+        if EDGE_HAAR_CASCADE:
+            return EDGE_HAAR_CASCADE
+        # cv2.data only exists in the pip opencv-python wheels, not in Debian's python3-opencv
+        dirs = ([cv2.data.haarcascades] if hasattr(cv2, 'data') else []) + HAAR_CASCADE_DIRS
+        for directory in dirs:
+            path = os.path.join(directory, HAAR_CASCADE_FILE)
+            if os.path.exists(path):
+                return path
+        return None
+    
+    def initialize_face_detector(self):
+        """
+        Load the edge face detector: YuNet when EDGE_DETECTOR_MODEL points to its .onnx file, else a
+        Haar cascade. Without either, face_detector stays None and full frames are uploaded.
+        """
+        try:
+            if EDGE_DETECTOR_MODEL and os.path.exists(EDGE_DETECTOR_MODEL) and hasattr(cv2, 'FaceDetectorYN'):
+                self.face_detector = ('yunet', cv2.FaceDetectorYN.create(EDGE_DETECTOR_MODEL, '', (640, 480), EDGE_SCORE_THRESHOLD))
+                self.log(f"Edge face detector: YuNet ({EDGE_DETECTOR_MODEL})")
+                return
+            if EDGE_DETECTOR_MODEL:
+                self.log(f"WARNING: Cannot load YuNet model {EDGE_DETECTOR_MODEL}, trying a Haar cascade")
+            
+            # OpenCV 5 dropped the Haar cascades; it needs the YuNet model
+            cascade_path = self.find_haar_cascade() if hasattr(cv2, 'CascadeClassifier') else None
+            if cascade_path is None:
+                self.log("WARNING: No edge face detector available (set EDGE_DETECTOR_MODEL or EDGE_HAAR_CASCADE), "
+                         "uploading full frames")
+                return
+            cascade = cv2.CascadeClassifier(cascade_path)
+            if cascade.empty():
+                self.log(f"WARNING: Failed to load Haar cascade {cascade_path}, uploading full frames")
+                return
+            self.face_detector = ('haar', cascade)
+            self.log(f"Edge face detector: Haar cascade ({cascade_path})")
+        except Exception as e:
+            self.face_detector = None
+            self.log(f"WARNING: Failed to initialize edge face detector ({e}), uploading full frames")
+    
+    def detect_faces(self, frame):
+        """
+        Run the edge detector on a frame.
+        Returns a list of {"box": [x1, y1, x2, y2], "kpts": 5x[x, y] or None, "conf": float} in frame pixels.
+        """
+        kind, detector = self.face_detector
+        h, w = frame.shape[:2]
+        faces = []
+        if kind == 'yunet':
+            detector.setInputSize((w, h))
+            _, detections = detector.detect(frame)
+            for d in (detections if detections is not None else []):
+                x, y, bw, bh = d[:4]
+                if min(bw, bh) < EDGE_MIN_FACE:
+                    continue
+                faces.append({
+                    "box": [int(x), int(y), int(x + bw) - 1, int(y + bh) - 1],
+                    # right eye, left eye, nose tip, right and left mouth corners: the ArcFace template order
+                    "kpts": d[4:14].reshape(5, 2).tolist(),
+                    "conf": float(d[14])
+                })
+        else:
+            gray = cv2.equalizeHist(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            for (x, y, bw, bh) in detector.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5,
+                                                            minSize=(EDGE_MIN_FACE, EDGE_MIN_FACE)):
+                faces.append({"box": [int(x), int(y), int(x + bw) - 1, int(y + bh) - 1], "kpts": None, "conf": 1.0})
+        return faces
+    
+    def crop_faces(self, frame, faces):
+        """Cut a crop padded by EDGE_CROP_PADDING around every face; records each crop rectangle in its face entry"""
+        h, w = frame.shape[:2]
+        crops = []
+        for face in faces:
+            x1, y1, x2, y2 = face["box"]
+            pad_x = int((x2 - x1 + 1) * EDGE_CROP_PADDING)
+            pad_y = int((y2 - y1 + 1) * EDGE_CROP_PADDING)
+            cx1, cy1 = max(0, x1 - pad_x), max(0, y1 - pad_y)
+            cx2, cy2 = min(w - 1, x2 + pad_x), min(h - 1, y2 + pad_y)
+            face["crop"] = [cx1, cy1, cx2, cy2]
+            crops.append(frame[cy1:cy2 + 1, cx1:cx2 + 1])
+        return crops
+    
+    def send_faces_to_face_service(self, frame):
+        """
+        Detect faces on the Pi and upload only the padded crops with their boxes
+        (one request to /process_faces_with_attendance). Falls back to the full frame
+        when no face is found and EDGE_FALLBACK_FULL_FRAME is set.
+        """
+        try:
+            if self.current_period_id is None:
+                self.log("ERROR: No period ID available")
+                return False
+            
+            start = time.time()
+            faces = self.detect_faces(frame)
+            self.log(f"Edge detector found {len(faces)} faces in {time.time() - start:.2f}s")
+            
+            if not faces:
+                if EDGE_FALLBACK_FULL_FRAME:
+                    return self.send_to_face_service(frame)
+                self.log("No faces found, nothing to upload")
+                return True
+            
+            files = []
+            for i, crop in enumerate(self.crop_faces(frame, faces)):
+                success, buffer = cv2.imencode('.jpg', crop)
+                if not success:
+                    self.log("ERROR: Failed to encode face crop")
+                    return False
+                files.append(('faces', (f'face_{i}.jpg', buffer.tobytes(), 'image/jpeg')))
+            data = {
+                'period_id': str(self.current_period_id),
+                'class_id': str(CLASS_ID),
+                'timestamp': datetime.now().isoformat(),
+                'boxes': json.dumps(faces),
+                'async': 'true' if ASYNC_UPLOAD else 'false'
+            }
+            
+            headers = {"X-API-Key": PUBLIC_API_KEY}
+            url = f"{FACE_SERVICE_URL}/process_faces_with_attendance"
+            
+            self.log(f"Sending {len(files)} face crops ({sum(len(f[1][1]) for f in files) // 1024} KB) to face service: {url}")
+            response = requests.post(
+                url,
+                files=files,
+                data=data,
+                headers=headers,
+                timeout=10 if ASYNC_UPLOAD else 30
+            )
+            
+            if response.status_code == 202:
+                result = response.json()
+                self.log(f"Face service queued face crops as job {result.get('job_id')} (queue depth {result.get('queue_depth')})")
+                return True
+            elif response.status_code == 200:
+                result = response.json()
+                predicted_count = len(result.get('predicted_students', []))
+                self.log(f"Face service processed face crops: {predicted_count} students identified")
+                return True
+            elif response.status_code == 429:
+                self.schedule_retry(response)
+                return False
+            else:
+                self.log(f"ERROR: Face service returned status {response.status_code}: {response.text}")
+                return False
+        
+        except requests.exceptions.ConnectionError:
+            self.log("ERROR: Cannot connect to face service")
+            return False
+        except Exception as e:
+            self.log(f"ERROR: Failed to send face crops to face service: {e}")
+            return False
+    
     def send_to_face_service(self, frame):
         """Send captured image to face service for processing"""
         try:
@@ -137,7 +363,8 @@ class AttendanceCapture:
             data = {
                 'period_id': str(self.current_period_id),
                 'class_id': str(CLASS_ID),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'async': 'true' if ASYNC_UPLOAD else 'false'
             }
             
             headers = {"X-API-Key": PUBLIC_API_KEY}
@@ -149,14 +376,21 @@ class AttendanceCapture:
                 files=files,
                 data=data,
                 headers=headers,
-                timeout=30
+                timeout=10 if ASYNC_UPLOAD else 30
             )
             
-            if response.status_code == 200:
+            if response.status_code == 202:
+                result = response.json()
+                self.log(f"Face service queued image as job {result.get('job_id')} (queue depth {result.get('queue_depth')})")
+                return True
+            elif response.status_code == 200:
                 result = response.json()
                 predicted_count = len(result.get('predicted_students', []))
                 self.log(f"Face service processed image: {predicted_count} students identified")
                 return True
+            elif response.status_code == 429:
+                self.schedule_retry(response)
+                return False
             else:
                 self.log(f"ERROR: Face service returned status {response.status_code}: {response.text}")
                 return False
@@ -168,6 +402,71 @@ class AttendanceCapture:
             self.log(f"ERROR: Failed to send image to face service: {e}")
             return False
     
+    def schedule_retry(self, response):
+        """Face service is overloaded: capture again after its Retry-After instead of the full interval"""
+        try:
+            retry_after = int(response.headers.get('Retry-After', POLL_INTERVAL))
+        except ValueError:
+            retry_after = POLL_INTERVAL
+        self.retry_at = time.time() + retry_after
+        self.log(f"Face service is overloaded, retrying in {retry_after} seconds")
+    
+    def send_burst_to_face_service(self, frames):
+        """Send a burst of frames to the face service in one request (attendance is marked once)"""
+        try:
+            if self.current_period_id is None:
+                self.log("ERROR: No period ID available")
+                return False
+            
+            files = []
+            for i, frame in enumerate(frames):
+                success, buffer = cv2.imencode('.jpg', frame)
+                if not success:
+                    self.log("ERROR: Failed to encode image")
+                    return False
+                files.append(('images', (f'captured_image_{i}.jpg', buffer.tobytes(), 'image/jpeg')))
+            data = {
+                'period_id': str(self.current_period_id),
+                'class_id': str(CLASS_ID),
+                'timestamp': datetime.now().isoformat(),
+                'async': 'true' if ASYNC_UPLOAD else 'false'
+            }
+            
+            headers = {"X-API-Key": PUBLIC_API_KEY}
+            url = f"{FACE_SERVICE_URL}/process_burst_with_attendance"
+            
+            self.log(f"Sending burst of {len(frames)} frames to face service: {url}")
+            response = requests.post(
+                url,
+                files=files,
+                data=data,
+                headers=headers,
+                timeout=10 if ASYNC_UPLOAD else 60
+            )
+            
+            if response.status_code == 202:
+                result = response.json()
+                self.log(f"Face service queued burst as job {result.get('job_id')} (queue depth {result.get('queue_depth')})")
+                return True
+            elif response.status_code == 200:
+                result = response.json()
+                predicted_count = len(result.get('predicted_students', []))
+                self.log(f"Face service processed burst: {predicted_count} students identified")
+                return True
+            elif response.status_code == 429:
+                self.schedule_retry(response)
+                return False
+            else:
+                self.log(f"ERROR: Face service returned status {response.status_code}: {response.text}")
+                return False
+        
+        except requests.exceptions.ConnectionError:
+            self.log("ERROR: Cannot connect to face service")
+            return False
+        except Exception as e:
+            self.log(f"ERROR: Failed to send burst to face service: {e}")
+            return False
+    
     def run(self):
         """Main run loop"""
         self.log("Starting Attendance Capture System")
@@ -176,12 +475,18 @@ class AttendanceCapture:
         self.log(f"Class ID: {CLASS_ID}")
         self.log(f"Capture Interval: {CAPTURE_INTERVAL} seconds")
         self.log(f"Poll Interval: {POLL_INTERVAL} seconds")
+        self.log(f"Frames per capture: {BURST_FRAMES}")
+        self.log(f"Scene-change gating: {'on (max ' + str(SCENE_MAX_SKIPS) + ' skips)' if SCENE_GATING else 'off'}")
+        self.log(f"Edge face detection: {'on' if EDGE_FACE_DETECTION else 'off'}")
         self.log(f"Platform: {'Windows' if IS_WINDOWS else 'Raspberry Pi' if IS_RASPBERRY_PI else 'Linux'}")
         
         if not self.initialize_camera():
             self.log("ERROR: Failed to initialize camera. Exiting.")
             return
         
+        if EDGE_FACE_DETECTION and BURST_FRAMES <= 1:
+            self.initialize_face_detector()
+        
         try:
             while True:
                 # Check for running period
@@ -191,14 +496,28 @@ class AttendanceCapture:
                     if not self.running:
                         self.running = True
                         self.last_capture_time = 0  # Reset timer
+                        self.reset_scene()  # Always upload the first frame of a period
                     
                     # Capture and send image at intervals
                     current_time = time.time()
-                    if current_time - self.last_capture_time >= CAPTURE_INTERVAL:
-                        frame = self.capture_image()
-                        
-                        if frame is not None:
-                            self.send_to_face_service(frame)
+                    retry_due = self.retry_at is not None and current_time >= self.retry_at
+                    if retry_due or current_time - self.last_capture_time >= CAPTURE_INTERVAL:
+                        self.retry_at = None
+                        if BURST_FRAMES > 1:
+                            frames = self.capture_burst()
+                            
+                            if frames:
+                                upload, thumbnail = self.should_upload(frames[0])
+                                if upload and self.send_burst_to_face_service(frames):
+                                    self.accept_scene(thumbnail)
+                        else:
+                            frame = self.capture_image()
+                            
+                            if frame is not None:
+                                upload, thumbnail = self.should_upload(frame)
+                                send = self.send_faces_to_face_service if self.face_detector else self.send_to_face_service
+                                if upload and send(frame):
+                                    self.accept_scene(thumbnail)
                         
                         self.last_capture_time = current_time
                 else:
@@ -94,6 +94,7 @@ class Period(db.Model):
 
 class Attendance(db.Model):
     __tablename__ = 'attendance'
+    __table_args__ = (db.UniqueConstraint('student_id', 'period_id', name='attendance_student_period_key'),)
     id = db.Column(db.BigInteger, primary_key=True)
     student_id = db.Column(db.BigInteger, db.ForeignKey('students.id'))
     period_id = db.Column(db.BigInteger, db.ForeignKey('periods.id'))
@@ -121,4 +122,4 @@ class StudentEmbedding(db.Model):
     vector = db.Column(ARRAY(db.Float), nullable=False) # PostgreSQL Array
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    image = db.relationship("StudentImage", back_populates="embeddings")
\ No newline at end of file
+    image = db.relationship("StudentImage", back_populates="embeddings")
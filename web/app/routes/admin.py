@@ -255,37 +255,70 @@ async def generate_embeddings():
 @admin_bp.route('/api/get_embeddings', methods=['GET'])
 def get_embeddings():
     """
-    Endpoint for face_service to fetch all student embeddings.
-    Used by load_embeddings.py to load embeddings into memory.
+    Page through student embeddings with their owner, ordered by embedding id.
+    
+    Query parameters:
+    - after_id: last embedding id of the previous page (default 0)
+    - limit: max embeddings per page (default 1000, max 10000)
+    - student_id / class_id: optional filters
+    
+    Returns the page, next_after_id for the following request, and has_more.
     """
-    from app.models import StudentEmbedding
+    from app.models import StudentEmbedding, StudentImage
     
     try:
-        # Query all embeddings with their associated student info
-        embeddings_data = db.session.query(
+        try:
+            after_id = int(request.args.get('after_id', 0))
+            limit = min(int(request.args.get('limit', 1000)), 10000)
+            student_id = int(request.args['student_id']) if request.args.get('student_id') else None
+            class_id = int(request.args['class_id']) if request.args.get('class_id') else None
+        except ValueError:
+            return jsonify({"error": "after_id, limit, student_id and class_id must be integers"}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        
+        # Keyset pagination over one joined query (no per-row image lookups)
+        query = db.session.query(
             StudentEmbedding.id,
             StudentEmbedding.image_id,
             StudentEmbedding.vector,
-            StudentEmbedding.created_at
-        ).all()
+            StudentEmbedding.created_at,
+            StudentImage.student_id,
+            Student.class_id
+        ).join(
+            StudentImage, StudentEmbedding.image_id == StudentImage.id
+        ).join(
+            Student, StudentImage.student_id == Student.id
+        ).filter(
+            StudentEmbedding.id > after_id
+        )
+        if student_id is not None:
+            query = query.filter(StudentImage.student_id == student_id)
+        if class_id is not None:
+            query = query.filter(Student.class_id == class_id)
         
-        if not embeddings_data:
-            return jsonify([]), 200
+        rows = query.order_by(StudentEmbedding.id).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
         
-        # Format response for face_service
-        result = []
-        for embedding in embeddings_data:
-            # Get student_id from the image
-            from app.models import StudentImage
-            image = StudentImage.query.get(embedding.image_id)
-            if image:
-                result.append({
-                    "student_id": image.student_id,
-                    "embedding": embedding.vector.tolist() if hasattr(embedding.vector, 'tolist') else list(embedding.vector),
-                    "created_at": embedding.created_at.isoformat() if embedding.created_at else None
-                })
+        result = [
+            {
+                "embedding_id": r.id,
+                "image_id": r.image_id,
+                "student_id": r.student_id,
+                "class_id": r.class_id,
+                "embedding": r.vector.tolist() if hasattr(r.vector, 'tolist') else list(r.vector),
+                "created_at": r.created_at.isoformat() if r.created_at else None
+            }
+            for r in rows
+        ]
         
-        return jsonify(result), 200
+        return jsonify({
+            "embeddings": result,
+            "count": len(result),
+            "next_after_id": rows[-1].id if rows else after_id,
+            "has_more": has_more
+        }), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -1,16 +1,24 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, stream_with_context, current_app
 from app.extensions import db
 from app.models import Student, Period, Attendance, TeacherSubject, Subject, StudentEmbedding, StudentImage
+from sqlalchemy import literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.utils.embedding_codec import EMBEDDINGS_MEDIA_TYPE, SUPPORTED_DTYPES, wants_binary, iter_packed_embeddings
 from functools import wraps
 import os
 from datetime import date
 import traceback
+import json
+import time
 
 public_bp = Blueprint('public', __name__)
 
 # Get API key from environment
 API_KEY = os.getenv('PUBLIC_API_KEY', 'default-insecure-key')
 
+# Rows fetched from the database (and written to the response) per chunk in get-embeddings
+EXPORT_BATCH_SIZE = int(os.getenv('EMBEDDINGS_EXPORT_BATCH_SIZE', '500'))
+
 def require_api_key(f):
     """Decorator to validate API key in request headers"""
     @wraps(f)
@@ -69,24 +77,16 @@ def mark_attendance():
         if not period:
             return jsonify({"error": "Period not found"}), 404
         
-        # Check if attendance record already exists
-        existing_attendance = Attendance.query.filter_by(
+        # Insert, or update the existing row (unique on student_id, period_id)
+        stmt = pg_insert(Attendance).values(
             student_id=student_id,
-            period_id=period_id
-        ).first()
-        
-        if existing_attendance:
-            # Update existing record
-            existing_attendance.status = status
-        else:
-            # Create new attendance record
-            attendance = Attendance(
-                student_id=student_id,
-                period_id=period_id,
-                status=status
-            )
-            db.session.add(attendance)
-        
+            period_id=period_id,
+            status=status
+        )
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['student_id', 'period_id'],
+            set_={"status": stmt.excluded.status}
+        ))
         db.session.commit()
         
         return jsonify({
@@ -102,6 +102,101 @@ def mark_attendance():
         return jsonify({"error": str(e)}), 500
 
 
+@public_bp.route('/api/mark-attendance/bulk', methods=['POST'])
+@require_api_key
+def mark_attendance_bulk():
+    """
+    Mark attendance for many students in one period with set-based queries.
+    
+    Expected JSON:
+    {
+        "period_id": 1,
+        "records": [
+            {"student_id": 1, "status": "present"},  # status defaults to "present"
+            {"student_id": 2, "status": "late"}
+        ]
+    }
+    
+    Returns a result per student: "created", "updated", "not_found" or "invalid".
+    """
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({"error": "No JSON data provided"}), 400
+        
+        period_id = data.get('period_id')
+        records = data.get('records')
+        
+        if not period_id or not isinstance(records, list):
+            return jsonify({"error": "period_id and a records list are required"}), 400
+        
+        period = Period.query.get(period_id)
+        if not period:
+            return jsonify({"error": "Period not found"}), 404
+        
+        # Validate each record; the last record for a student wins
+        valid_statuses = ['present', 'absent', 'late']
+        results = {}
+        requested = {}
+        for record in records:
+            student_id = record.get('student_id') if isinstance(record, dict) else None
+            status = str(record.get('status', 'present')).lower() if isinstance(record, dict) else None
+            try:
+                student_id = int(student_id)
+            except (TypeError, ValueError):
+                results[str(student_id)] = {"student_id": student_id, "result": "invalid", "error": "Invalid student_id"}
+                continue
+            if status not in valid_statuses:
+                results[student_id] = {"student_id": student_id, "result": "invalid",
+                                       "error": f"Invalid status. Must be one of: {', '.join(valid_statuses)}"}
+                requested.pop(student_id, None)
+                continue
+            requested[student_id] = status
+            results.pop(student_id, None)
+        
+        # One IN query for the students that exist
+        known_ids = {
+            row.id for row in db.session.query(Student.id).filter(Student.id.in_(list(requested))).all()
+        } if requested else set()
+        for student_id in requested:
+            if student_id not in known_ids:
+                results[student_id] = {"student_id": student_id, "result": "not_found", "error": "Student not found"}
+        to_mark = {s: status for s, status in requested.items() if s in known_ids}
+        
+        if to_mark:
+            # One INSERT ... ON CONFLICT DO UPDATE for every student; xmax = 0 only on freshly inserted rows
+            stmt = pg_insert(Attendance).values([
+                {"student_id": s, "period_id": period_id, "status": status} for s, status in to_mark.items()
+            ])
+            written = db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['student_id', 'period_id'],
+                set_={"status": stmt.excluded.status}
+            ).returning(Attendance.student_id, literal_column("xmax = 0").label("created"))).all()
+            db.session.commit()
+            
+            for row in written:
+                results[row.student_id] = {
+                    "student_id": row.student_id,
+                    "status": to_mark[row.student_id],
+                    "result": "created" if row.created else "updated"
+                }
+        
+        marked = sum(1 for r in results.values() if r["result"] in ("created", "updated"))
+        return jsonify({
+            "message": f"Attendance marked for {marked} of {len(results)} students",
+            "period_id": period.id,
+            "marked": marked,
+            "failed": len(results) - marked,
+            "results": list(results.values())
+        }), 200
+    
+    except Exception as e:
+        db.session.rollback()
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
 @public_bp.route('/api/get-period-by-date', methods=['GET'])
 @require_api_key
 def get_period_by_date():
@@ -399,39 +494,187 @@ def get_embeddings():
     Get all student embeddings for face recognition.
     Used by face_service to load embeddings for student matching.
     
-    Returns list of students with their embeddings.
+    Returns list of students with their embeddings, streamed in chunks from a single
+    joined query (rows are read from the database EXPORT_BATCH_SIZE at a time).
+    With "Accept: application/x-embeddings" the response is the binary format from
+    app/utils/embedding_codec.py instead (query parameter dtype=float32|float16).
     """
     try:
-        # Get all students with their embeddings
-        embeddings_data = []
-        
-        students = Student.query.all()
-        
-        for student in students:
-            # Get all embeddings for this student across all their images
-            student_embeddings = db.session.query(StudentEmbedding).join(
-                StudentImage, StudentEmbedding.image_id == StudentImage.id
-            ).filter(
-                StudentImage.student_id == student.id
-            ).all()
-            
-            # Aggregate embeddings for the student
-            if student_embeddings:
-                for emb in student_embeddings:
-                    embeddings_data.append({
-                        "student_id": student.id,
-                        "student_name": student.name,
-                        "roll_no": student.roll_no,
-                        "embedding": emb.vector,  # PostgreSQL ARRAY will be converted to list
-                        "embedding_id": emb.id
-                    })
+        binary = wants_binary(request.accept_mimetypes)
+        dtype = request.args.get('dtype', 'float32')
+        if binary and dtype not in SUPPORTED_DTYPES:
+            return jsonify({"error": f"Invalid dtype. Must be one of: {', '.join(SUPPORTED_DTYPES)}"}), 400
+        
+        # Take the delta cursor first: everything written by transactions older than it
+        # is committed (or rolled back) and in the export; anything newer is sent by the next delta
+        cursor = current_embedding_cursor()
+        
+        # One query for every embedding with its owner; yield_per streams it with a server-side cursor
+        rows = db.session.query(
+            StudentEmbedding.id,
+            StudentEmbedding.vector,
+            Student.id.label('student_id'),
+            Student.name,
+            Student.roll_no,
+            Student.class_id
+        ).join(
+            StudentImage, StudentEmbedding.image_id == StudentImage.id
+        ).join(
+            Student, StudentImage.student_id == Student.id
+        ).order_by(StudentEmbedding.id).yield_per(EXPORT_BATCH_SIZE)
+        
+        if binary:
+            records = ((r.id, r.student_id, r.class_id, r.vector) for r in rows)
+            body = iter_packed_embeddings(records, dtype=dtype, chunk_rows=EXPORT_BATCH_SIZE, cursor=cursor)
+            return Response(stream_with_context(body), mimetype=EMBEDDINGS_MEDIA_TYPE)
+        
+        return Response(stream_with_context(_stream_embeddings_json(rows, cursor)), mimetype='application/json')
+    
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+
+def _stream_embeddings_json(rows, cursor):
+    """Same document as jsonify({"cursor", "embeddings", "count"}), written EXPORT_BATCH_SIZE rows at a time."""
+    yield '{"cursor": ' + json.dumps(cursor) + ', "embeddings": ['
+    count = 0
+    chunk = []
+    for r in rows:
+        chunk.append(json.dumps({
+            "student_id": r.student_id,
+            "student_name": r.name,
+            "roll_no": r.roll_no,
+            "class_id": r.class_id,
+            "embedding": r.vector,  # PostgreSQL ARRAY will be converted to list
+            "embedding_id": r.id
+        }))
+        if len(chunk) >= EXPORT_BATCH_SIZE:
+            yield (', ' if count else '') + ', '.join(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        yield (', ' if count else '') + ', '.join(chunk)
+        count += len(chunk)
+    yield '], "count": ' + str(count) + '}'
+
+
+def safe_xid():
+    """
+    Oldest transaction still running (pg_snapshot_xmin). Every transaction with a lower id has
+    committed or rolled back, so rows they wrote can no longer appear behind a delta cursor.
+    """
+    return int(db.session.execute(text("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")).scalar())
+
+
+def current_embedding_cursor():
+    """Delta cursor a full export is consistent with: all embeddings and tombstones written before safe_xid()."""
+    xid = safe_xid()
+    return {
+        "embedding_xid": xid,
+        "embedding_id": 0,
+        "tombstone_xid": xid,
+        "tombstone_id": 0
+    }
+
+
+@public_bp.route('/api/get-embeddings-delta', methods=['GET'])
+@require_api_key
+def get_embeddings_delta():
+    """
+    Get embeddings created and deleted since a cursor.
+    Used by face_service to update its in-memory gallery without a full reload.
+    
+    Query parameters (the fields of the previous cursor):
+    - after_embedding_xid, after_embedding_id: last embedding (writing transaction, id) already applied
+    - after_tombstone_xid, after_tombstone_id: last tombstone (writing transaction, id) already applied
+    - synced_at: unix time of the client's last successful sync (optional)
+    - limit: max embeddings per page (default 1000)
+    
+    Rows are ordered by the transaction that wrote them and only returned once that transaction
+    and every older one has finished, so a row committed late is never skipped.
+    Returns new embeddings, deleted embedding ids, the next cursor and has_more, or
+    {"full_reload_required": true} when synced_at is older than the tombstone retention.
+    """
+    try:
+        try:
+            after_embedding_xid = int(request.args.get('after_embedding_xid', 0))
+            after_embedding_id = int(request.args.get('after_embedding_id', 0))
+            after_tombstone_xid = int(request.args.get('after_tombstone_xid', 0))
+            after_tombstone_id = int(request.args.get('after_tombstone_id', 0))
+            synced_at = float(request.args['synced_at']) if 'synced_at' in request.args else None
+            limit = min(int(request.args.get('limit', 1000)), 10000)
+        except ValueError:
+            return jsonify({"error": "cursor fields, synced_at and limit must be numbers"}), 400
+        
+        retention = current_app.config['EMBEDDING_TOMBSTONE_RETENTION']
+        if synced_at is not None and synced_at < time.time() - retention:
+            # deletions since then may already be pruned (scheduler_jobs.prune_embedding_tombstones)
+            return jsonify({"full_reload_required": True}), 200
+        
+        high_xid = safe_xid()
+        
+        # New embeddings with their owner in one joined query, keyset-paged by (txid, id)
+        rows = db.session.query(
+            StudentEmbedding.id,
+            StudentEmbedding.vector,
+            literal_column("students_embeddings.txid::text").label('txid'),
+            Student.id.label('student_id'),
+            Student.class_id
+        ).join(
+            StudentImage, StudentEmbedding.image_id == StudentImage.id
+        ).join(
+            Student, StudentImage.student_id == Student.id
+        ).filter(
+            text("(students_embeddings.txid, students_embeddings.id) > (CAST(:after_xid AS text)::xid8, :after_id) "
+                 "AND students_embeddings.txid < CAST(:high_xid AS text)::xid8")
+        ).params(
+            after_xid=after_embedding_xid, after_id=after_embedding_id, high_xid=high_xid
+        ).order_by(
+            literal_column("students_embeddings.txid"), StudentEmbedding.id
+        ).limit(limit + 1).all()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        
+        tombstones = db.session.execute(text(
+            "SELECT id, embedding_id, txid::text AS txid FROM embedding_tombstones "
+            "WHERE (txid, id) > (CAST(:after_xid AS text)::xid8, :after_id) "
+            "AND txid < CAST(:high_xid AS text)::xid8 ORDER BY txid, id"
+        ), {"after_xid": after_tombstone_xid, "after_id": after_tombstone_id, "high_xid": high_xid}).all()
+        
+        embeddings_data = [
+            {
+                "embedding_id": r.id,
+                "student_id": r.student_id,
+                "class_id": r.class_id,
+                "embedding": r.vector
+            }
+            for r in rows
+        ]
+        deleted = [t.embedding_id for t in tombstones]
+        
+        # a complete page covers every transaction below high_xid; the cursor never moves back
+        if has_more:
+            embedding_cursor = (int(rows[-1].txid), rows[-1].id)
+        else:
+            embedding_cursor = max((after_embedding_xid, after_embedding_id), (high_xid, 0))
+        tombstone_cursor = max((after_tombstone_xid, after_tombstone_id), (high_xid, 0))
         
         return jsonify({
-            "count": len(embeddings_data),
-            "embeddings": embeddings_data
+            "embeddings": embeddings_data,
+            "deleted": deleted,
+            "cursor": {
+                "embedding_xid": embedding_cursor[0],
+                "embedding_id": embedding_cursor[1],
+                "tombstone_xid": tombstone_cursor[0],
+                "tombstone_id": tombstone_cursor[1]
+            },
+            "has_more": has_more
         }), 200
     
     except Exception as e:
+        db.session.rollback()
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
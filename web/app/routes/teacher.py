@@ -4,6 +4,7 @@ from app.models import Teacher, Period, Attendance, Student, TeacherSubject, Cla
 from app.utils.helpers import format_time, serialize_model, DAY_MAP
 from datetime import date, datetime
 from sqlalchemy import desc, func, join
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 teacher_bp = Blueprint('teacher', __name__)
 
@@ -180,9 +181,10 @@ def mark_attendance():
     action = data.get('action') # 'present' or 'remove'
     
     if action == 'present':
-        exists = Attendance.query.filter_by(period_id=period_id, student_id=student_id).first()
-        if not exists:
-            db.session.add(Attendance(period_id=period_id, student_id=student_id, status='present'))
+        # Keep an existing record as is (unique on student_id, period_id)
+        db.session.execute(pg_insert(Attendance).values(
+            period_id=period_id, student_id=student_id, status='present'
+        ).on_conflict_do_nothing(index_elements=['student_id', 'period_id']))
     elif action == 'remove':
         Attendance.query.filter_by(period_id=period_id, student_id=student_id).delete()
         
@@ -1,4 +1,5 @@
 from datetime import datetime, date
+from sqlalchemy import text
 from app.extensions import db
 from app.models import WeeklyPeriod, Period, TeacherSubject
 
@@ -13,6 +14,9 @@ def init_scheduler(app, scheduler):
     # Run every minute to update status (scheduled -> running -> completed)
     scheduler.add_job(func=update_period_status, trigger="interval", minutes=1, args=[app])
     
+    # Run every hour to drop embedding tombstones past their retention
+    scheduler.add_job(func=prune_embedding_tombstones, trigger="interval", hours=1, args=[app])
+    
     scheduler.start()
 
 def generate_today_periods(app):
@@ -79,4 +83,18 @@ def update_period_status(app):
         for p in completed_query.all():
             p.status = 'completed'
 
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+def prune_embedding_tombstones(app):
+    """
+    Drops embedding tombstones older than EMBEDDING_TOMBSTONE_RETENTION.
+    Face services that synced less recently get full_reload_required from get-embeddings-delta.
+    """
+    with app.app_context():
+        result = db.session.execute(
+            text("DELETE FROM embedding_tombstones WHERE deleted_at < LOCALTIMESTAMP - make_interval(secs => :retention)"),
+            {"retention": app.config['EMBEDDING_TOMBSTONE_RETENTION']}
+        )
+        db.session.commit()
+        if result.rowcount:
+            print(f"Pruned {result.rowcount} embedding tombstones.")
@@ -0,0 +1,93 @@
+"""
+Binary transport format for reference embeddings (no numpy needed on the web side).
+
+Layout (all numbers little-endian):
+    4 bytes   magic b"EMB1"
+    4 bytes   uint32 header length H
+    H bytes   UTF-8 JSON header: dim, dtype + extra fields (cursor, ...)
+    padding   zero bytes so the records start on a 16-byte boundary
+    records   fixed-size, one per embedding:
+                int64 embedding_id | int64 student_id | int64 class_id (-1 = none) | dim x float32/float16
+    16 bytes  trailer: uint64 record count | 8 bytes end marker b"EMB1-END"
+
+Fixed-size records let the web service stream rows as it reads them, and let the
+face service decode the whole body with a single np.frombuffer call (structured dtype).
+The trailer is only written after the last row was read, so a body cut short by a
+failure mid-stream (which still holds whole records) is rejected by the reader.
+"""
+
+import json
+import struct
+import sys
+from array import array
+
+EMBEDDINGS_MEDIA_TYPE = "application/x-embeddings"
+MAGIC = b"EMB1"
+END_MARKER = b"EMB1-END"
+ALIGNMENT = 16
+NO_CLASS = -1
+SUPPORTED_DTYPES = ("float32", "float16")
+
+
+def wants_binary(accept_mimetypes):
+    """True if the client explicitly listed the binary embeddings media type in Accept."""
+    return any(mimetype == EMBEDDINGS_MEDIA_TYPE and quality > 0 for mimetype, quality in accept_mimetypes)
+
+
+def pack_preamble(dim, dtype="float32", **extra):
+    """Magic, header and padding; everything before the first record."""
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported dtype {dtype}. Must be one of: {', '.join(SUPPORTED_DTYPES)}")
+    header = dict(extra)
+    header.update({"dim": dim, "dtype": dtype})
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    prefix_len = len(MAGIC) + 4 + len(header_bytes)
+    padding = (-prefix_len) % ALIGNMENT
+    return MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes + b"\0" * padding
+
+
+def pack_record(embedding_id, student_id, class_id, vector, dim, dtype="float32"):
+    if len(vector) != dim:
+        raise ValueError(f"Embedding {embedding_id} has {len(vector)} dims, expected {dim}")
+    ids = struct.pack("<qqq", embedding_id, student_id, NO_CLASS if class_id is None else class_id)
+    if dtype == "float32":
+        values = array('f', vector)
+        if sys.byteorder != "little":
+            values.byteswap()
+        return ids + values.tobytes()
+    return ids + struct.pack(f"<{dim}e", *vector)
+
+
+def pack_trailer(count):
+    return struct.pack("<Q", count) + END_MARKER
+
+
+def iter_packed_embeddings(rows, dtype="float32", chunk_rows=256, **extra):
+    """
+    Stream the binary format from rows: iterable of (embedding_id, student_id, class_id, vector).
+    Yields the preamble, chunks of chunk_rows records, then the trailer.
+    """
+    rows = iter(rows)
+    first = next(rows, None)
+    dim = len(first[3]) if first is not None else 0
+    yield pack_preamble(dim, dtype, **extra)
+    if first is None:
+        yield pack_trailer(0)
+        return
+
+    count = 1
+    chunk = [pack_record(*first, dim=dim, dtype=dtype)]
+    for row in rows:
+        chunk.append(pack_record(*row, dim=dim, dtype=dtype))
+        count += 1
+        if len(chunk) >= chunk_rows:
+            yield b"".join(chunk)
+            chunk = []
+    if chunk:
+        yield b"".join(chunk)
+    yield pack_trailer(count)
+
+
+def pack_embeddings(rows, dtype="float32", **extra):
+    """Whole body at once (see iter_packed_embeddings)."""
+    return b"".join(iter_packed_embeddings(rows, dtype=dtype, **extra))
@@ -9,6 +9,9 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     UPLOAD_FOLDER = "temp_uploads"
     FACE_SERVICE_URL = os.getenv("FACE_SERVICE_URL")
+    # Seconds embedding tombstones are kept for /public/api/get-embeddings-delta; at least twice
+    # the face service's full reload interval (EMBEDDINGS_FULL_RELOAD_INTERVAL, daily)
+    EMBEDDING_TOMBSTONE_RETENTION = int(os.getenv("EMBEDDING_TOMBSTONE_RETENTION", str(2 * 86400)))
     
     # Ensure upload folder exists
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
\ No newline at end of file